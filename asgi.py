@@ -0,0 +1,589 @@
+"""Asyncio front end for /stream and /watch.
+
+Each viewer of a long video holds a connection for minutes. Under the WSGI server
+that pins a thread per viewer; here the chunk reads from Redis and the proxied reads
+from S3 are awaited on one event loop, so a worker can carry thousands of streams.
+Every other route is the Flask app, mounted unchanged.
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import mimetypes
+import os
+import threading
+import time
+import urllib.parse
+import redis
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.responses import HTMLResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+from werkzeug.http import parse_range_header
+import mp4box
+import metrics
+import origin
+from app import app as flask_app
+from fillscheduler import fill_scheduler
+from demand import record_view_async
+from warmup import warmup_scheduler
+from redisclient import get_async_redis, mark_redis_down, redis_available, redis_marked_down
+from redispython import slugify, open_tee
+from chunkstore import (chunk_store, byte_counter, hot_chunks, chunk_digest, manifest_digests,
+                        pinned_chunks, fill_digests_async)
+from try2 import (is_current_meta, prefetcher, prefetch_moov, stream_etag, validator_headers,
+                  evaluate_preconditions, origin_range, relay_origin, plan_sliced_miss, STREAM_READAHEAD_CHUNKS,
+                  READTHROUGH_WAIT_SECONDS, READTHROUGH_MAX_LAG_MB)
+
+VIDEO_SERVER_HOST = os.environ['VIDEO_SERVER_HOST']
+
+
+async def redis_ready():
+    """redis_available() without blocking the event loop on a reconnect probe"""
+    if not redis_marked_down():
+        return True
+    return await asyncio.to_thread(redis_available)
+
+
+async def get_video_meta(slug):
+    meta = await get_async_redis().hgetall(f"video:{slug}:meta")
+    if not meta:
+        return None
+    return {key.decode(): value if key == b"manifest" else value.decode() for key, value in meta.items()}
+
+
+async def get_cached_meta(slug):
+    """The meta hash of a completed fill of the current version of the video, or None"""
+    if not await redis_ready():
+        return None
+    meta = await get_video_meta(slug)
+    return meta if is_current_meta(meta) else None
+
+
+async def is_video_cached(slug):
+    return await get_cached_meta(slug) is not None
+
+
+async def is_fill_in_progress(slug):
+    return await redis_ready() and bool(await get_async_redis().exists(f"video:{slug}:filling"))
+
+
+async def read_origin_bytes(video_name, start, end, slice_size=0):
+    """Return (bytes [start, end) of a video from S3, its ETag), or None if S3 fails; see try2"""
+    url = f"{VIDEO_SERVER_HOST}{urllib.parse.unquote(video_name)}"
+    ranges = origin.upstream_ranges(start, end, slice_size)
+    parts = []
+    etag = None
+    for first, last in ranges:
+        try:
+            response = await origin.get_async_client().get(url, headers={'Range': f"bytes={first}-{last}"})
+        except Exception as e:
+            print(f"[!] Could not fetch {video_name} bytes {first}-{last} from S3: {e}")
+            return None
+        if response.status_code != 206:
+            return None
+        if etag is not None and response.headers.get('ETag', '') != etag:
+            return None  # Changed on S3 between two slices
+        parts.append(response.content)
+        etag = response.headers.get('ETag', '')
+    offset = start - ranges[0][0]
+    data = b"".join(parts)[offset:offset + end - start]
+    if len(data) != end - start:
+        return None
+    return data, etag
+
+
+async def repair_chunks(slug, video_name, meta, indexes, chunks):
+    """Async repair_chunks from try2: refill a batch's gaps from S3 and re-admit them"""
+    chunk_size = int(meta["chunk_size"])
+    digests = manifest_digests(meta["manifest"], indexes)
+    pinned = (set(pinned_chunks(mp4box.decode_boxes(meta), chunk_size, int(meta["total_size"])))
+              if await chunk_store.is_pinned_async(slug) else set())
+    missing = [index for index, chunk in zip(indexes, chunks) if chunk is None]
+    claimed, busy = prefetcher.claim(slug, missing)
+    try:
+        if busy:
+            # Another reader or the prefetcher is already fetching these; take its copy
+            await asyncio.to_thread(prefetcher.wait_fetched, slug, busy, READTHROUGH_WAIT_SECONDS)
+            chunks = list(chunks)
+            positions = [indexes.index(index) for index in busy]
+            stored = await chunk_store.fetch_async(slug, busy, [digests[i] for i in positions], chunk_size)
+            for i, chunk in zip(positions, stored):
+                chunks[i] = chunk
+            missing = [index for index, chunk in zip(indexes, chunks) if chunk is None]
+            if not missing:
+                return chunks
+        return await _fetch_missing_chunks(slug, video_name, meta, indexes, chunks, digests, pinned, missing)
+    finally:
+        prefetcher.release(slug, claimed)
+
+
+async def _fetch_missing_chunks(slug, video_name, meta, indexes, chunks, digests, pinned, missing):
+    r = get_async_redis()
+    chunk_size = int(meta["chunk_size"])
+    start = missing[0] * chunk_size
+    end = min((missing[-1] + 1) * chunk_size, int(meta["total_size"]))
+
+    fetched = await read_origin_bytes(video_name, start, end, chunk_size)
+    if fetched is None:
+        return None
+    data, etag = fetched
+    if meta.get("etag") and etag and etag != meta["etag"]:
+        print(f"[~] {slug} changed on S3, dropping the cached copy")
+        await r.delete(f"video:{slug}:meta")
+        return None
+
+    repaired = []
+    pipe = r.pipeline(transaction=False)
+    for index, digest, chunk in zip(indexes, digests, chunks):
+        if chunk is None:
+            offset = (index - missing[0]) * chunk_size
+            chunk = data[offset:offset + chunk_size]
+            if chunk_digest(chunk) != digest:
+                print(f"[~] {slug} chunk {index} no longer matches its manifest, dropping the cached copy")
+                await r.delete(f"video:{slug}:meta")
+                return None
+            chunk_store.store(pipe, slug, index, digest, chunk, chunk_size, pinned=index in pinned)
+        repaired.append(chunk)
+    try:
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"[!] Could not re-admit chunks of {slug}: {e}")
+    return repaired
+
+
+async def iter_video_range(slug, video_name, start, end, meta, window=STREAM_READAHEAD_CHUNKS):
+    """Yield the bytes [start, end) of a cached video, `window` chunks per chunk store fetch.
+
+    As in try2, hot chunks come from this worker's memory first, and the prefetcher
+    is asked to store the chunks past each window. Partial chunks are yielded as
+    memoryview slices, and the disk store's chunks are views of its mmap, so the
+    ASGI server sends both without copying.
+    """
+    chunk_size = int(meta["chunk_size"])
+    first_chunk = start // chunk_size
+    last_chunk = (end - 1) // chunk_size
+    source_bytes = {"memory": 0, "store": 0, "origin": 0}
+
+    metrics.active_streams.labels('cache').inc()
+    try:
+        for batch_start in range(first_chunk, last_chunk + 1, window):
+            indexes = range(batch_start, min(batch_start + window, last_chunk + 1))
+            prefetcher.request(slug, video_name, meta, (indexes[-1] + 1) * chunk_size, end)
+            digests = manifest_digests(meta["manifest"], indexes)
+            chunks = hot_chunks.get_many(digests)
+            in_memory = {index for index, chunk in zip(indexes, chunks) if chunk is not None}
+            if len(in_memory) < len(indexes):
+                wanted = [index for index in indexes if index not in in_memory]
+                wanted_digests = [digest for index, digest in zip(indexes, digests) if index not in in_memory]
+                fetched = dict(zip(wanted, await chunk_store.fetch_async(slug, wanted, wanted_digests, chunk_size)))
+                chunks = [fetched.get(index, chunk) for index, chunk in zip(indexes, chunks)]
+
+            missing = {index for index, chunk in zip(indexes, chunks) if chunk is None}
+            if missing:
+                chunks = await repair_chunks(slug, video_name, meta, indexes, chunks)
+                if chunks is None:
+                    print(f"[!] Could not recover chunks {sorted(missing)} of {slug}, ending stream")
+                    return
+
+            for index, digest, chunk in zip(indexes, digests, chunks):
+                if index not in in_memory:
+                    hot_chunks.put(digest, chunk)
+                chunk_start = index * chunk_size
+                lo = max(start - chunk_start, 0)
+                hi = min(end - chunk_start, len(chunk))
+                yield chunk if (lo, hi) == (0, len(chunk)) else memoryview(chunk)[lo:hi]
+                source = "memory" if index in in_memory else "origin" if index in missing else "store"
+                source_bytes[source] += hi - lo
+            del chunks
+    finally:
+        metrics.active_streams.labels('cache').dec()
+        byte_counter.record(source_bytes["memory"], source_bytes["store"], source_bytes["origin"])
+
+
+async def get_fill_progress(slug, wait=READTHROUGH_WAIT_SECONDS):
+    """The progress hash of a running fill once it knows the video's size, or None"""
+    deadline = time.monotonic() + wait
+    while await is_fill_in_progress(slug):
+        progress = await get_async_redis().hgetall(f"video:{slug}:progress")
+        if not progress:
+            break  # Locked but not filling, see try2
+        progress = {key.decode(): value.decode() for key, value in progress.items()}
+        if int(progress.get("expected_size", 0)):
+            return progress
+        if time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(0.05)
+    return None
+
+
+async def iter_origin_range(video_name, start, end, slice_size=0, etag=None):
+    """Yield the bytes [start, end) of a video straight from S3, as whole slices with slice_size; see try2"""
+    url = f"{VIDEO_SERVER_HOST}{urllib.parse.unquote(video_name)}"
+    client = origin.get_async_client()
+    position = start
+    for first, last in origin.upstream_ranges(start, end, slice_size):
+        request = client.build_request('GET', url, headers={'Range': f"bytes={first}-{last}"})
+        response = await client.send(request, stream=True)
+        try:
+            response.raise_for_status()
+            if etag and stream_etag(response.headers.get('ETag', '')) != etag:
+                print(f"[!] {video_name} changed on S3 while streaming, ending stream")
+                return
+            # An origin that ignores Range sends the whole file; skip to our offset
+            skip = position - (0 if response.status_code == 200 else first)
+            remaining = (end if response.status_code == 200 else min(end, last + 1)) - position
+            async for data in response.aiter_bytes(64 * 1024):
+                if skip:
+                    dropped = min(skip, len(data))
+                    data = data[dropped:]
+                    skip -= dropped
+                if not data:
+                    continue
+                data = data[:remaining]
+                yield data
+                position += len(data)
+                remaining -= len(data)
+                if not remaining:
+                    break
+        finally:
+            await response.aclose()
+        if response.status_code == 200 or position < min(end, last + 1):
+            return  # The whole file has been read, or the slice came up short
+
+
+async def iter_proxied_range(video_name, start, end, slice_size, etag):
+    """iter_origin_range for a /stream miss, counted like the other response bodies"""
+    metrics.active_streams.labels('origin').inc()
+    bytes_sent = 0
+    try:
+        async for data in iter_origin_range(video_name, start, end, slice_size, etag):
+            yield data
+            bytes_sent += len(data)
+    finally:
+        metrics.active_streams.labels('origin').dec()
+        byte_counter.record(origin_bytes=bytes_sent)
+
+
+class ChunkNotices:
+    """One subscription to every fill's chunks-ready channel per worker, shared by its
+    read-through viewers.
+
+    A pubsub keeps its pooled connection for as long as it is subscribed, so one per
+    viewer would drain the connection pool in a launch spike and stall every other
+    Redis call in the worker. Viewers register an asyncio.Event per video here instead,
+    and the single listener sets the events of a video when its fill stores chunks.
+    """
+
+    PATTERN = "video:*:chunks-ready"
+
+    def __init__(self):
+        self._waiters = {}  # slug -> events of the viewers waiting on its fill
+        self._task = None
+        self._subscribed = None
+
+    async def subscribe(self, slug):
+        """An event set whenever the fill of `slug` stores chunks, once notices are flowing"""
+        if self._task is None or self._task.done() or self._task.get_loop() is not asyncio.get_running_loop():
+            self._subscribed = asyncio.Event()
+            self._task = asyncio.create_task(self._run(self._subscribed))
+        ready = asyncio.Event()
+        self._waiters.setdefault(slug, set()).add(ready)
+        try:
+            await asyncio.wait_for(self._subscribed.wait(), READTHROUGH_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            pass  # Waits then run into their timeouts and go to S3
+        return ready
+
+    def unsubscribe(self, slug, ready):
+        waiters = self._waiters.get(slug)
+        if waiters is not None:
+            waiters.discard(ready)
+            if not waiters:
+                del self._waiters[slug]
+
+    async def _run(self, subscribed):
+        while True:
+            pubsub = get_async_redis().pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.psubscribe(self.PATTERN)
+                subscribed.set()
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if not message:
+                        continue
+                    slug = message["channel"].decode()[len("video:"):-len(":chunks-ready")]
+                    for ready in self._waiters.get(slug, ()):
+                        ready.set()
+            except redis.RedisError as e:
+                print(f"[!] Lost the chunks-ready subscription: {e}")
+                subscribed.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+
+chunk_notices = ChunkNotices()
+
+
+async def wait_for_chunk(slug, index, ready):
+    """Wait until the running fill has stored chunk `index`; False if it will not soon.
+
+    `ready` is the viewer's event from chunk_notices.
+    """
+    r = get_async_redis()
+    deadline = time.monotonic() + READTHROUGH_WAIT_SECONDS
+    while True:
+        # Cleared before progress is read so no notice in between is missed
+        ready.clear()
+        filling = await is_fill_in_progress(slug)
+        chunks_stored, chunk_size = await r.hmget(f"video:{slug}:progress", "chunks_stored", "chunk_size")
+        if not filling or chunks_stored is None:
+            # Completed since we looked, or committing; see try2
+            digest = (await fill_digests_async(slug, [index]))[0]
+            if digest is not None and await chunk_store.exists_async(slug, index, digest):
+                return True
+            if not filling:
+                return False
+        chunks_stored = int(chunks_stored or 0)
+        if index < chunks_stored:
+            return True
+        if (index - chunks_stored) * int(chunk_size or 0) >= READTHROUGH_MAX_LAG_MB * 1024 * 1024:
+            return False
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        try:
+            await asyncio.wait_for(ready.wait(), remaining)
+            deadline = time.monotonic() + READTHROUGH_WAIT_SECONDS
+        except asyncio.TimeoutError:
+            pass
+
+
+async def iter_read_through(slug, video_name, start, end, chunk_size, window=STREAM_READAHEAD_CHUNKS):
+    """Yield the bytes [start, end) of a video that is still being filled, as in try2"""
+    position = start
+    ready = None
+    stored_chunk = None
+    origin_bytes = 0
+    metrics.active_streams.labels('readthrough').inc()
+    try:
+        while position < end:
+            first_chunk = position // chunk_size
+            last_chunk = min((end - 1) // chunk_size, first_chunk + window - 1)
+            indexes = range(first_chunk, last_chunk + 1)
+            digests = await fill_digests_async(slug, indexes)
+            chunks = await chunk_store.fetch_async(slug, indexes, digests, chunk_size)
+
+            if chunks[0] is None and stored_chunk == first_chunk:
+                # Stored by the fill but not in this chunk store: read the window from S3
+                window_end = min(end, (last_chunk + 1) * chunk_size)
+                fetched = await read_origin_bytes(video_name, position, window_end, chunk_size)
+                if fetched is None:
+                    print(f"[!] Could not read {slug} bytes {position}-{window_end - 1} from S3, ending stream")
+                    return
+                yield fetched[0]
+                origin_bytes += window_end - position
+                position = window_end
+                continue
+
+            if chunks[0] is None:
+                if ready is None:
+                    ready = await chunk_notices.subscribe(slug)
+                if await wait_for_chunk(slug, first_chunk, ready):
+                    stored_chunk = first_chunk
+                    continue
+                print(f"[~] {slug} chunk {first_chunk} is not being filled soon, reading from S3")
+                async for data in iter_origin_range(video_name, position, end, chunk_size):
+                    yield data
+                    position += len(data)
+                    origin_bytes += len(data)
+                return
+
+            for index, chunk in zip(indexes, chunks):
+                if chunk is None:
+                    break
+                chunk_start = index * chunk_size
+                lo = position - chunk_start
+                hi = min(end - chunk_start, len(chunk))
+                yield chunk if (lo, hi) == (0, len(chunk)) else chunk[lo:hi]
+                position = chunk_start + hi
+            del chunks
+    finally:
+        metrics.active_streams.labels('readthrough').dec()
+        byte_counter.record(store_bytes=position - start - origin_bytes, origin_bytes=origin_bytes)
+        if ready is not None:
+            chunk_notices.unsubscribe(slug, ready)
+
+
+async def serve_video_range(video_name, request_headers):
+    """Async serve_video_range from try2: 200/206/304/416 from Redis, or None to go to S3"""
+    clean_name = slugify(urllib.parse.unquote(video_name))
+    meta = await get_cached_meta(clean_name)
+    if meta:
+        total_size = int(meta["total_size"])
+        content_type = meta.get("content_type", "video/mp4")
+        etag = stream_etag(meta.get("etag", ""), meta["manifest"])
+        last_modified = meta.get("last_modified")
+
+        def read(start, end):
+            prefetch_moov(clean_name, video_name, meta, start)
+            return iter_video_range(clean_name, video_name, start, end, meta)
+    else:
+        progress = await get_fill_progress(clean_name) if await redis_ready() else None
+        if not progress:
+            return None
+        total_size = int(progress["expected_size"])
+        chunk_size = int(progress["chunk_size"])
+        content_type = progress.get("content_type", "video/mp4")
+        etag = stream_etag(progress.get("etag", ""))
+        last_modified = progress.get("last_modified")
+        read = lambda start, end: iter_read_through(clean_name, video_name, start, end, chunk_size)
+
+    headers = validator_headers(etag, last_modified)
+    not_modified, range_header = evaluate_preconditions(request_headers, etag, last_modified)
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    byte_range = parse_range_header(range_header) if range_header else None
+    if byte_range is None or len(byte_range.ranges) != 1:
+        headers['Content-Length'] = str(total_size)
+        return StreamingResponse(read(0, total_size), media_type=content_type, headers=headers)
+
+    span = byte_range.range_for_length(total_size)
+    if span is None:
+        headers['Content-Range'] = f"bytes */{total_size}"
+        return Response(status_code=416, headers=headers)
+
+    start, end = span
+    headers['Content-Range'] = byte_range.to_content_range_header(total_size)
+    headers['Content-Length'] = str(end - start)
+    return StreamingResponse(read(start, end), status_code=206, media_type=content_type, headers=headers)
+
+
+async def tee_to_redis(video_name, response, client_chunk_size=64 * 1024):
+    """Async tee_to_redis from redispython: proxy an origin response while caching it.
+
+    Taking the lock and committing talk to Redis synchronously, so they run in a thread;
+    feeding chunks to the non-blocking writer does not wait on Redis.
+    """
+    tee = None
+    bytes_sent = 0
+    metrics.active_streams.labels('origin').inc()
+    try:
+        tee = await asyncio.to_thread(open_tee, video_name, response)
+        async for data in response.aiter_bytes(client_chunk_size):
+            yield data
+            bytes_sent += len(data)
+            if tee is not None:
+                tee.feed(data)
+        if tee is not None:
+            await asyncio.to_thread(tee.finish)
+    finally:
+        metrics.active_streams.labels('origin').dec()
+        byte_counter.record(origin_bytes=bytes_sent)
+        if tee is not None and tee.session is not None:
+            # The client left early; awaiting here could be cancelled, so abandon in a thread
+            threading.Thread(target=tee.close, daemon=True).start()
+        await response.aclose()
+
+
+async def serve_origin(video_name, request_headers):
+    """Async serve_origin from try2: proxy /stream from S3, caching whole-file fetches"""
+    sliced = plan_sliced_miss(video_name, request_headers)
+    if sliced is not None:
+        status, headers, span, slice_size, etag = sliced
+        if status == 206:
+            await queue_fill(video_name)
+            media_type = mimetypes.guess_type(urllib.parse.unquote(video_name))[0] or 'video/mp4'
+            return StreamingResponse(iter_proxied_range(video_name, span[0], span[1], slice_size, etag),
+                                     status_code=206, media_type=media_type, headers=headers)
+        if status != 200:
+            return Response(status_code=status, headers=headers)
+        # If-Range no longer matches, so the client gets the whole video, and it is cached
+        request_headers = {}
+
+    client = origin.get_async_client()
+    url = f"{VIDEO_SERVER_HOST}{video_name}"
+    upstream_range = origin_range(request_headers.get('Range'))
+    response = await client.send(client.build_request(
+        'GET', url, headers={'Range': upstream_range} if upstream_range else None), stream=True)
+    relay = relay_origin(request_headers, upstream_range, response.status_code, response.headers)
+    if relay is None:
+        # If-Range no longer matches, so the client gets the whole video
+        await response.aclose()
+        upstream_range = None
+        response = await client.send(client.build_request('GET', url), stream=True)
+        relay = relay_origin({}, None, response.status_code, response.headers)
+
+    status, headers = relay
+    if status not in (200, 206):
+        await response.aclose()
+        if status == 304:
+            return Response(status_code=304, headers=headers)
+        return PlainTextResponse(f"Error streaming video: origin returned {status}", status_code=status)
+
+    if upstream_range:
+        await queue_fill(video_name)
+    return StreamingResponse(tee_to_redis(video_name, response), status_code=status,
+                             media_type=response.headers.get('Content-Type', 'video/mp4'), headers=headers)
+
+
+async def queue_fill(video_name):
+    """Start caching a video in the background unless a worker is already filling it"""
+    if await redis_ready() and not await is_fill_in_progress(slugify(urllib.parse.unquote(video_name))):
+        if not fill_scheduler.submit(video_name):
+            print(f"[!] Fill queue full, not caching {urllib.parse.unquote(video_name)}")
+
+
+def render(template_name, **context):
+    return flask_app.jinja_env.get_template(template_name).render(**context)
+
+
+async def watch(request):
+    """Watch video - tries Redis first, falls back to direct stream"""
+    video_name = request.path_params['video_name']
+    safe_video_name = urllib.parse.unquote(video_name)
+    clean_name = slugify(safe_video_name)
+    warmup_scheduler.start()
+
+    try:
+        if await redis_ready():
+            await record_view_async(safe_video_name)
+        if await is_video_cached(clean_name):
+            metrics.watch_requests.labels('hit').inc()
+            return HTMLResponse(render('videos.html',
+                                       video_name=safe_video_name,
+                                       video_url=f"/stream/{urllib.parse.quote(safe_video_name)}",
+                                       video_ready=True))
+        # Start background storage unless a worker is already filling it
+        await queue_fill(video_name)
+    except redis.ConnectionError as e:
+        mark_redis_down(e)
+
+    metrics.watch_requests.labels('miss').inc()
+    return HTMLResponse(render('watch.html', video_url=f"/stream/{video_name}"))
+
+
+async def stream(request):
+    """Stream video - byte ranges from Redis when cached, otherwise directly from S3"""
+    video_name = request.path_params['video_name']
+    try:
+        redis_response = await serve_video_range(video_name, request.headers)
+    except redis.ConnectionError as e:
+        mark_redis_down(e)
+        redis_response = None
+    if redis_response is not None:
+        return redis_response
+
+    try:
+        # Cache the bytes in Redis as they pass through to the client
+        return await serve_origin(video_name, request.headers)
+    except Exception as e:
+        return PlainTextResponse(f"Error streaming video: {e}", status_code=500)
+
+
+application = Starlette(routes=[
+    Route('/watch/{video_name:path}', watch),
+    Route('/stream/{video_name:path}', stream),
+    Mount('/', app=WsgiToAsgi(flask_app))
+])
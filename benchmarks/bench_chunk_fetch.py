@@ -0,0 +1,132 @@
+"""Benchmark: Redis round trips and wall time per GB for reading a cached video.
+
+Compares the original single-hash layout read with HKEYS + sort + one HGET per
+chunk against the batched MGET over content-addressed chunk keys in
+try2.get_video_chunks.
+Needs a local redis-server:
+
+    redis-server --save '' --appendonly no &
+    python benchmarks/bench_chunk_fetch.py --size-mb 256 --batches 1 4 16 64
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault('VIDEO_SERVER_HOST', 'http://localhost:8080/')
+os.environ.setdefault('REDIS_HOST', 'localhost')
+os.environ.setdefault('REDIS_PORT', '6379')
+os.environ.setdefault('REDIS_USER', 'default')
+os.environ.setdefault('REDIS_PASSWORD', '')
+
+import redis
+import try2
+from chunkstore import chunk_store, chunk_digest, chunk_key, DIGEST_SIZE
+
+BENCH_VIDEO = "bench_fetch.mp4"
+CHUNK_SIZE = 1024 * 1024
+
+
+class RoundTripCounter:
+    """Counts commands sent by a redis client; a pipeline counts as one round trip"""
+
+    def __init__(self, client):
+        self.client = client
+        self.count = 0
+        self._execute_command = client.execute_command
+
+    def __enter__(self):
+        def counting_execute_command(*args, **options):
+            self.count += 1
+            return self._execute_command(*args, **options)
+        self.client.execute_command = counting_execute_command
+        return self
+
+    def __exit__(self, *exc):
+        self.client.execute_command = self._execute_command
+
+
+def clear_video(client):
+    slug = try2.slugify(BENCH_VIDEO)
+    manifest = client.hget(f"video:{slug}:meta", "manifest") or b""
+    # Nothing else shares the random chunks, so drop them rather than leaving them to expire
+    chunks = [chunk_key(manifest[i:i + DIGEST_SIZE]) for i in range(0, len(manifest), DIGEST_SIZE)]
+    client.delete(f"video:{slug}:chunks", f"video:{slug}:meta", *chunks)
+    chunk_store.release(slug, [])
+
+
+def fill_video(client, size_mb):
+    """Store the synthetic video in both the legacy hash and the per-chunk keys"""
+    slug = try2.slugify(BENCH_VIDEO)
+    clear_video(client)
+
+    manifest = b""
+    pipe = client.pipeline(transaction=False)
+    for index in range(size_mb):
+        # Distinct chunks, so deduplication does not shrink the read
+        chunk = os.urandom(CHUNK_SIZE)
+        digest = chunk_digest(chunk)
+        manifest += digest
+        pipe.hset(f"video:{slug}:chunks", str(index), chunk)
+        chunk_store.store(pipe, slug, index, digest, chunk, CHUNK_SIZE)
+        if index % 64 == 63:
+            pipe.execute()
+    pipe.hset(f"video:{slug}:meta", mapping={
+        "total_chunks": size_mb,
+        "chunk_size": CHUNK_SIZE,
+        "total_size": size_mb * CHUNK_SIZE,
+        "original_name": BENCH_VIDEO,
+        "content_type": "video/mp4",
+        "manifest": manifest
+    })
+    pipe.execute()
+
+
+def legacy_get_video_chunks(client, video_name):
+    """The original read of the single-hash layout: HKEYS, sort in Python, one HGET per chunk"""
+    chunk_hash_key = f"video:{try2.slugify(video_name)}:chunks"
+    chunk_keys = client.hkeys(chunk_hash_key)
+    sorted_chunk_keys = sorted(chunk_keys, key=lambda x: int(x))
+    return [client.hget(chunk_hash_key, key) for key in sorted_chunk_keys]
+
+
+def measure(label, size_mb, read):
+    with RoundTripCounter(try2.redis_client) as counter:
+        started = time.perf_counter()
+        chunks = read()
+        elapsed = time.perf_counter() - started
+
+    read_mb = sum(len(chunk) for chunk in chunks) / (1024 * 1024)
+    assert read_mb == size_mb, f"{label}: read {read_mb} MB, expected {size_mb} MB"
+    per_gb = 1024 / size_mb
+    print(f"{label:<22} {counter.count * per_gb:>10.0f} {elapsed * per_gb:>10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size-mb', type=int, default=256, help="size of the synthetic video")
+    parser.add_argument('--batches', type=int, nargs='+', default=[1, 4, 16, 64],
+                        help="MGET batch sizes to measure")
+    args = parser.parse_args()
+
+    try:
+        try2.redis_client.ping()
+    except redis.RedisError:
+        sys.exit("[!] Redis not reachable, start a local redis-server first")
+
+    fill_video(try2.redis_client, args.size_mb)
+    print(f"{'method':<22} {'trips/GB':>10} {'sec/GB':>10}")
+    try:
+        measure("HKEYS + HGET", args.size_mb,
+                lambda: legacy_get_video_chunks(try2.redis_client, BENCH_VIDEO))
+        for batch_size in args.batches:
+            measure(f"MGET batch={batch_size}", args.size_mb,
+                    lambda: try2.get_video_chunks(BENCH_VIDEO, batch_size=batch_size))
+    finally:
+        clear_video(try2.redis_client)
+
+
+if __name__ == "__main__":
+    main()
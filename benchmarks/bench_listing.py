@@ -0,0 +1,119 @@
+"""Micro-benchmark: requests/sec for the / listing page against a stub S3 listing.
+
+Serves a synthetic bucket listing from a local HTTP server, points the app at it
+and compares three ways of producing the page:
+
+    legacy        the original / route: fetch and parse the S3 listing, then
+                  render_template_string over every file (legacy_listing.html
+                  is its desktop template, kept here unchanged)
+    compiled      render_template with Jinja's compiled-template cache
+    page cache    the / route, which reuses the page rendered for the listing version
+
+    python benchmarks/bench_listing.py --objects 5000 --seconds 3
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+
+
+def listing_xml(objects):
+    items = "".join(
+        f"<Contents><Key>videos/clip_{i:06d}.mp4</Key><Size>{(i % 500 + 1) * 1048576}</Size>"
+        f"<ETag>\"{i:032x}\"</ETag><LastModified>2024-01-01T00:00:00.000Z</LastModified></Contents>"
+        for i in range(objects)
+    )
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f'<IsTruncated>false</IsTruncated>{items}</ListBucketResult>').encode()
+
+
+def start_stub_s3(objects):
+    body = listing_xml(objects)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def measure(label, client, path, seconds):
+    client.get(path)  # Warm up
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        response = client.get(path)
+        assert response.status_code == 200, f"{label}: {response.status_code}"
+        count += 1
+    elapsed = time.perf_counter() - started
+    print(f"{label:<12} {count / elapsed:>10.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--objects', type=int, default=5000, help="objects in the stub bucket")
+    parser.add_argument('--seconds', type=float, default=3, help="duration of each measurement")
+    args = parser.parse_args()
+
+    os.environ['VIDEO_SERVER_HOST'] = start_stub_s3(args.objects)
+    os.environ.setdefault('REDIS_HOST', 'localhost')
+    os.environ.setdefault('REDIS_PORT', '6379')
+    os.environ.setdefault('REDIS_USER', 'default')
+    os.environ.setdefault('REDIS_PASSWORD', '')
+
+    import requests
+    from flask import render_template, render_template_string
+    import app as webapp
+    from catalogue import catalogue
+
+    with open(os.path.join(BENCH_DIR, 'legacy_listing.html'), encoding='utf-8') as f:
+        legacy_template = f.read()
+
+    @webapp.app.route('/_bench/legacy')
+    def legacy():
+        response = requests.get(os.environ['VIDEO_SERVER_HOST'])
+        response.raise_for_status()
+        root = ET.fromstring(response.content)
+        ns = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+        files = []
+        for item in root.findall('s3:Contents', ns):
+            key = item.find('s3:Key', ns).text
+            size = int(item.find('s3:Size', ns).text)
+            if key.lower().endswith(('.mp4', '.mkv', '.mov', '.webm', '.mp3', '.wav')):
+                files.append({
+                    'name': key,
+                    'size': f"{size / (1024*1024):.2f} MB",
+                    'extension': key.lower().split('.')[-1].upper()
+                })
+        return render_template_string(legacy_template, files=files)
+
+    @webapp.app.route('/_bench/compiled')
+    def compiled():
+        files, _, _ = catalogue.snapshot()
+        return render_template(webapp.LISTING_TEMPLATES['desktop'], total=len(files))
+
+    client = webapp.app.test_client()
+    print(f"{args.objects} objects in stub listing")
+    measure("legacy", client, '/_bench/legacy', args.seconds)
+    measure("compiled", client, '/_bench/compiled', args.seconds)
+    measure("page cache", client, '/', args.seconds)
+
+
+if __name__ == "__main__":
+    main()
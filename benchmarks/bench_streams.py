@@ -0,0 +1,94 @@
+"""Load test: how many concurrent /stream viewers a server sustains at a playback bitrate.
+
+Each simulated viewer opens /stream/<video> and reads it at --bitrate, the way a
+player drains its buffer. A viewer "keeps up" if its time to first byte is under
+--max-ttfb and it never falls more than --max-lag seconds behind real time. The
+concurrency is stepped up until fewer than --keep-up of the viewers keep up.
+
+Run the sync and asyncio servers against the same Redis and origin and compare:
+
+    python app.py                                     # sync, :5000
+    uvicorn asgi:application --port 5001              # asyncio
+    python benchmarks/bench_streams.py --url http://127.0.0.1:5000 --url http://127.0.0.1:5001 \\
+        --video sample.mp4 --steps 50,100,200,500,1000
+"""
+import argparse
+import asyncio
+import time
+import urllib.parse
+import httpx
+
+
+async def viewer(client, url, bitrate, seconds, max_lag):
+    """Read a stream at `bitrate` bytes/s for `seconds`; returns (ttfb, worst lag, bytes)"""
+    started = time.perf_counter()
+    ttfb = None
+    received = 0
+    worst_lag = 0.0
+    try:
+        async with client.stream('GET', url) as response:
+            if response.status_code not in (200, 206):
+                return None, float('inf'), 0
+            async for data in response.aiter_bytes(64 * 1024):
+                now = time.perf_counter()
+                if ttfb is None:
+                    ttfb = now - started
+                    playback_start = now
+                received += len(data)
+                # How far behind the player is: the time the bytes were due minus now
+                worst_lag = max(worst_lag, now - playback_start - received / bitrate)
+                if worst_lag > max_lag or now - playback_start >= seconds:
+                    break
+                # Pace reads like a player whose buffer is full
+                ahead = received / bitrate - (now - playback_start)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+    except httpx.HTTPError:
+        return ttfb, float('inf'), received
+    return ttfb, worst_lag, received
+
+
+async def run_step(url, concurrency, args):
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=0)
+    timeout = httpx.Timeout(args.max_ttfb + args.seconds, connect=args.max_ttfb)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        results = await asyncio.gather(*(
+            viewer(client, url, args.bitrate, args.seconds, args.max_lag) for _ in range(concurrency)))
+
+    kept_up = [r for r in results if r[0] is not None and r[0] <= args.max_ttfb and r[1] <= args.max_lag]
+    ttfbs = sorted(r[0] for r in results if r[0] is not None)
+    p95_ttfb = ttfbs[int(len(ttfbs) * 0.95) - 1] if ttfbs else float('inf')
+    total_mb = sum(r[2] for r in results) / (1024 * 1024)
+    return len(kept_up) / concurrency, p95_ttfb, total_mb
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', action='append', required=True, help="server base URL (repeat to compare)")
+    parser.add_argument('--video', required=True, help="video name as it appears in /stream/<name>")
+    parser.add_argument('--steps', default='25,50,100,200,400', help="comma-separated viewer counts")
+    parser.add_argument('--bitrate', type=float, default=2.5, help="playback bitrate in Mbit/s")
+    parser.add_argument('--seconds', type=float, default=20, help="how long each viewer watches")
+    parser.add_argument('--max-ttfb', type=float, default=2, help="seconds allowed to the first byte")
+    parser.add_argument('--max-lag', type=float, default=2, help="seconds a viewer may fall behind")
+    parser.add_argument('--keep-up', type=float, default=0.99, help="fraction of viewers that must keep up")
+    args = parser.parse_args()
+    args.bitrate = args.bitrate * 1_000_000 / 8
+    steps = [int(step) for step in args.steps.split(',')]
+
+    for base_url in args.url:
+        url = f"{base_url.rstrip('/')}/stream/{urllib.parse.quote(args.video)}"
+        print(f"{base_url}")
+        capacity = 0
+        for concurrency in steps:
+            kept_up, p95_ttfb, total_mb = await run_step(url, concurrency, args)
+            print(f"  {concurrency:>6} viewers  {kept_up:>7.1%} kept up  p95 ttfb {p95_ttfb * 1000:>8.0f} ms"
+                  f"  {total_mb:>9.1f} MB")
+            if kept_up < args.keep_up:
+                break
+            capacity = concurrency
+        print(f"  sustained {capacity} concurrent streams at {args.bitrate * 8 / 1_000_000:.1f} Mbit/s\n")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
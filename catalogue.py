@@ -0,0 +1,224 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import xml.etree.ElementTree as ET
+import origin
+
+VIDEO_SERVER_HOST = os.environ['VIDEO_SERVER_HOST']
+# How often the background refresher re-walks the bucket listing
+CATALOGUE_REFRESH_SECONDS = float(os.getenv('CATALOGUE_REFRESH_SECONDS', 60))
+# How long the very first page view may wait for the initial listing
+CATALOGUE_INITIAL_WAIT_SECONDS = float(os.getenv('CATALOGUE_INITIAL_WAIT_SECONDS', 10))
+
+MEDIA_EXTENSIONS = ('.mp4', '.mkv', '.mov', '.webm', '.mp3', '.wav')
+S3_NS = {'s3': 'http://s3.amazonaws.com/doc/2006-03-01/'}
+
+SORT_KEYS = {
+    'name': lambda f: f['name'].lower(),
+    'size': lambda f: f['size_bytes'],
+    'modified': lambda f: f['last_modified']
+}
+
+
+def iter_listing_pages(listing_url):
+    """Yield the parsed XML of every page of an S3 bucket listing.
+
+    Uses ListObjectsV2 continuation tokens, falling back to a v1 marker (the last key
+    of the page) for servers that ignore list-type=2.
+    """
+    params = {'list-type': '2'}
+    while True:
+        response = origin.get(listing_url, params=params)
+        response.raise_for_status()
+        root = ET.fromstring(response.content)
+        yield root
+
+        if root.findtext('s3:IsTruncated', default='false', namespaces=S3_NS) != 'true':
+            return
+        token = root.findtext('s3:NextContinuationToken', namespaces=S3_NS)
+        if token:
+            params = {'list-type': '2', 'continuation-token': token}
+        else:
+            keys = root.findall('s3:Contents/s3:Key', S3_NS)
+            if not keys:
+                return
+            params = {'marker': root.findtext('s3:NextMarker', namespaces=S3_NS) or keys[-1].text}
+
+
+def list_media_files(listing_url):
+    files = []
+    for root in iter_listing_pages(listing_url):
+        for item in root.findall('s3:Contents', S3_NS):
+            key = item.find('s3:Key', S3_NS).text
+            if not key.lower().endswith(MEDIA_EXTENSIONS):
+                continue
+            size = int(item.find('s3:Size', S3_NS).text)
+            files.append({
+                'name': key,
+                'size_bytes': size,
+                'size': f"{size / (1024*1024):.2f} MB",
+                'extension': key.lower().split('.')[-1].upper(),
+                'etag': item.findtext('s3:ETag', default='', namespaces=S3_NS).strip('"'),
+                'last_modified': item.findtext('s3:LastModified', default='', namespaces=S3_NS)
+            })
+    return files
+
+
+def tokenize(text):
+    return [token for token in re.split(r'[^0-9a-z]+', text.lower()) if token]
+
+
+class CatalogueIndex:
+    """Search index over one listing, built once per refresh.
+
+    Every name is lowercased and split into tokens, and every 3-character window of
+    each token is posted to a trigram index. A query token is matched as a substring
+    of a name token: candidates come from intersecting its trigram postings and are
+    then verified, so tokens shorter than 3 characters just verify by scanning. Each
+    sort order is precomputed, so a page is a filter plus a slice.
+    """
+
+    def __init__(self, files):
+        self.files = files
+        self._tokens = [tokenize(f['name']) for f in files]
+        self._trigrams = {}
+        for position, tokens in enumerate(self._tokens):
+            for token in tokens:
+                for start in range(len(token) - 2):
+                    self._trigrams.setdefault(token[start:start + 3], set()).add(position)
+        self._orders = {name: sorted(range(len(files)), key=lambda i, key=key: key(files[i]))
+                        for name, key in SORT_KEYS.items()}
+
+    def _matches(self, query_token, positions):
+        """Positions whose name has a token containing query_token"""
+        if len(query_token) >= 3:
+            candidates = None
+            for start in range(len(query_token) - 2):
+                posting = self._trigrams.get(query_token[start:start + 3], set())
+                candidates = posting if candidates is None else candidates & posting
+                if not candidates:
+                    return set()
+            positions = candidates if positions is None else positions & candidates
+        elif positions is None:
+            positions = range(len(self.files))
+        return {i for i in positions if any(query_token in token for token in self._tokens[i])}
+
+    def search(self, query='', page=1, limit=50, sort='name'):
+        """Return (matching files on the page, total number of matches)"""
+        descending = sort.startswith('-')
+        order = self._orders.get(sort.lstrip('-'), self._orders['name'])
+        if descending:
+            order = order[::-1]
+
+        matched = None
+        for query_token in tokenize(query):
+            matched = self._matches(query_token, matched)
+            if not matched:
+                return [], 0
+
+        if matched is not None:
+            order = [i for i in order if i in matched]
+        offset = (page - 1) * limit
+        return [self.files[i] for i in order[offset:offset + limit]], len(order)
+
+
+class Catalogue:
+    """In-process index of the media files in the bucket, kept fresh by a background thread.
+
+    Page views read the last good listing and never wait on S3, except for the first
+    one in a process, which waits up to CATALOGUE_INITIAL_WAIT_SECONDS for it. If a
+    refresh fails, the previous listing keeps being served.
+    """
+
+    def __init__(self, listing_url, refresh_seconds=CATALOGUE_REFRESH_SECONDS):
+        self.listing_url = listing_url
+        self.refresh_seconds = refresh_seconds
+        self.files = []
+        self.index = CatalogueIndex([])
+        self._entries = {}
+        self.version = None  # Digest of the listing, changes whenever any entry does
+        self.updated_at = None
+        self.error = None
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def snapshot(self, wait=CATALOGUE_INITIAL_WAIT_SECONDS):
+        """Return (files, version, error) for the current listing"""
+        self._start()
+        self._loaded.wait(wait)
+        with self._lock:
+            return self.files, self.version, self.error
+
+    def search(self, query='', page=1, limit=50, sort='name'):
+        """Return (files on the page, total matches, listing version)"""
+        self._start()
+        self._loaded.wait(CATALOGUE_INITIAL_WAIT_SECONDS)
+        with self._lock:
+            index, version = self.index, self.version
+        files, total = index.search(query, page, limit, sort)
+        return files, total, version
+
+    def is_current(self, name, etag):
+        """Whether `etag` is still the listed ETag of `name`; never waits on S3.
+
+        Names the listing does not have (not loaded yet, or added since) are trusted,
+        so only an object that was overwritten invalidates what was cached from it.
+        """
+        self._start()
+        with self._lock:
+            listed = self._entries.get(name)
+        return listed is None or listed['etag'] == etag.strip('"')
+
+    def entry(self, name):
+        """The listing entry for `name`, or None if it is not listed; never waits on S3"""
+        self._start()
+        with self._lock:
+            return self._entries.get(name)
+
+    def refresh(self):
+        started = time.monotonic()
+        try:
+            files = list_media_files(self.listing_url)
+        except Exception as e:
+            print(f"[!] Failed to refresh S3 listing: {e}")
+            with self._lock:
+                self.error = e
+            return
+
+        index = CatalogueIndex(files)
+        digest = hashlib.sha1()
+        for f in files:
+            digest.update(f"{f['name']}\0{f['etag']}\0{f['size_bytes']}\0{f['last_modified']}\n".encode())
+        with self._lock:
+            if digest.hexdigest() != self.version:
+                print(f"[+] S3 listing changed: {len(files)} media files "
+                      f"({time.monotonic() - started:.2f}s)")
+            self.files = files
+            self.index = index
+            self._entries = {f['name']: f for f in files}
+            self.version = digest.hexdigest()
+            self.updated_at = time.time()
+            self.error = None
+        self._loaded.set()
+
+    def _start(self):
+        # Started lazily so that a pre-forking server starts it in each worker process
+        with self._lock:
+            if self._thread:
+                return
+            self._thread = threading.Thread(target=self._run, name="catalogue-refresh", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            self.refresh()
+            if not self._loaded.is_set():
+                # Never loaded: give up waiting callers, keep retrying in the background
+                self._loaded.set()
+            time.sleep(self.refresh_seconds)
+
+
+catalogue = Catalogue(VIDEO_SERVER_HOST)
@@ -0,0 +1,619 @@
+"""Where cached video chunks live, which of them may be evicted, and cache statistics.
+
+CHUNK_STORE selects the backend per deployment; both cover the operations the read
+and fill paths need (store, fetch, exists, count, release), and Redis always keeps
+the meta, progress and lock keys.
+
+Each video is cut into chunks of its own size, chosen at fill time by
+chunk_size_for() and recorded in its meta hash: a short clip gets small chunks,
+so a seek or a repair fetches little, and a long film gets large ones, so it
+needs fewer keys and a smaller manifest. Every chunk is identified by its
+BLAKE2b digest. A video's meta hash holds its
+manifest, the digests of its chunks in order (DIGEST_SIZE bytes each), written
+when the fill commits; while a fill runs the digests so far are appended to
+video:{slug}:digests.
+
+redis: chunks are content addressed, one key per distinct chunk, chunk:{digest},
+so a video uploaded twice under different names, or re-uploaded unchanged, is
+stored once. Every chunk is its own key, so under memory pressure Redis drops a
+cold stretch of a movie rather than the whole movie, and readers fetch a missing
+stretch from S3 and put it back. Eviction is steered through TTLs with
+`maxmemory-policy volatile-lfu`: every chunk is written with CHUNK_TTL_SECONDS,
+which makes it evictable, least frequently read first, so the popular segments
+of a video outlive the parts nobody watches. When a fill commits, the chunks in
+the first CACHE_HEAD_MB of the video and those holding an MP4's ftyp and moov
+boxes, wherever they are in the file (see mp4box), are pinned: their TTL is
+removed, so every title starts fast. A fill that never commits pins nothing.
+Pinned chunks can never be evicted, so they are held to CACHE_PINNED_MB in all:
+each title's pinned bytes are recorded in pinned:titles, and once they add up to
+more than that, the titles watched least over the last DEMAND_HOURS (see demand)
+have their pinned chunks given the normal TTL again. The meta hash has no TTL.
+
+disk: see DiskChunkStore.
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+import redis
+import metrics
+import mp4box
+from demand import redis_demand
+from redisclient import redis_client, get_async_redis
+
+# Chunk backend for this deployment: "redis" or "disk"
+CHUNK_STORE = os.getenv('CHUNK_STORE', 'redis')
+# Leading megabytes of each video kept out of eviction
+CACHE_HEAD_MB = float(os.getenv('CACHE_HEAD_MB', 8))
+# Megabytes of pinned chunks kept across all titles; past it the least watched titles are unpinned
+CACHE_PINNED_MB = float(os.getenv('CACHE_PINNED_MB', 1024))
+# Lifetime of the other chunks; long, since the TTL is there to make them evictable
+CHUNK_TTL_SECONDS = int(os.getenv('CHUNK_TTL_SECONDS', 30 * 24 * 3600))
+# Bounds on a video's chunk size, and roughly how many chunks a video is cut into between them
+CHUNK_SIZE_MIN_KB = int(os.getenv('CHUNK_SIZE_MIN_KB', 256))
+CHUNK_SIZE_MAX_KB = int(os.getenv('CHUNK_SIZE_MAX_KB', 4096))
+CHUNK_TARGET_COUNT = int(os.getenv('CHUNK_TARGET_COUNT', 1024))
+# Disk backend: where the video files go and how much space they may take
+CHUNK_STORE_DIR = os.getenv('CHUNK_STORE_DIR', '/var/cache/cdn/chunks')
+CHUNK_STORE_MAX_GB = float(os.getenv('CHUNK_STORE_MAX_GB', 20))
+# Disk backend: video files kept mapped per worker
+CHUNK_STORE_OPEN_FILES = int(os.getenv('CHUNK_STORE_OPEN_FILES', 256))
+# How often each worker adds its byte counters to the shared stats hash
+BYTE_STATS_FLUSH_SECONDS = float(os.getenv('BYTE_STATS_FLUSH_SECONDS', 5))
+# Memory each worker may use for hot chunks in front of the chunk store; 0 turns the tier off
+HOT_CHUNK_CACHE_MB = int(os.getenv('HOT_CHUNK_CACHE_MB', 0))
+
+BYTE_STATS_KEY = "stats:bytes"
+# Bytes of pinned chunks per title, by slug
+PINNED_TITLES_KEY = "pinned:titles"
+# Where the bytes sent to viewers came from: worker memory (L1), the chunk store (L2) or S3
+BYTE_SOURCES = ("memory", "store", "origin")
+# Keys per EXISTS / EXPIRE batch
+KEY_BATCH = 1000
+# Bytes of BLAKE2b digest per chunk in a manifest
+DIGEST_SIZE = 16
+
+
+def chunk_digest(chunk):
+    return hashlib.blake2b(chunk, digest_size=DIGEST_SIZE).digest()
+
+
+def manifest_digests(manifest, indexes):
+    """The digests of chunks `indexes` in a manifest, with None past its end"""
+    digests = []
+    for index in indexes:
+        digest = manifest[index * DIGEST_SIZE:(index + 1) * DIGEST_SIZE]
+        digests.append(bytes(digest) if len(digest) == DIGEST_SIZE else None)
+    return digests
+
+
+def digests_key(slug):
+    """Digests of the chunks a fill in progress has stored, in order"""
+    return f"video:{slug}:digests"
+
+
+def fill_digests(slug, indexes):
+    """Digests of chunks `indexes` of a video being filled, or from its manifest once it committed"""
+    first_chunk = min(indexes)
+    blob = redis_client.getrange(digests_key(slug), first_chunk * DIGEST_SIZE,
+                                 (max(indexes) + 1) * DIGEST_SIZE - 1)
+    digests = manifest_digests(blob, [index - first_chunk for index in indexes])
+    if None in digests:
+        manifest = redis_client.hget(f"video:{slug}:meta", "manifest")
+        if manifest:
+            digests = manifest_digests(manifest, indexes)
+    return digests
+
+
+async def fill_digests_async(slug, indexes):
+    client = get_async_redis()
+    first_chunk = min(indexes)
+    blob = await client.getrange(digests_key(slug), first_chunk * DIGEST_SIZE,
+                                 (max(indexes) + 1) * DIGEST_SIZE - 1)
+    digests = manifest_digests(blob, [index - first_chunk for index in indexes])
+    if None in digests:
+        manifest = await client.hget(f"video:{slug}:meta", "manifest")
+        if manifest:
+            digests = manifest_digests(manifest, indexes)
+    return digests
+
+
+def chunk_key(digest):
+    return f"chunk:{digest.hex()}"
+
+
+def chunk_keys(digests):
+    # A digest that is not known yet gets a key no chunk is stored under
+    return [chunk_key(digest) if digest else "chunk:" for digest in digests]
+
+
+def chunk_size_for(total_size):
+    """The chunk size for a new fill: the smallest power of two from CHUNK_SIZE_MIN_KB
+    that cuts total_size into at most CHUNK_TARGET_COUNT chunks, capped at CHUNK_SIZE_MAX_KB"""
+    chunk_size = CHUNK_SIZE_MIN_KB * 1024
+    while chunk_size < CHUNK_SIZE_MAX_KB * 1024 and chunk_size * CHUNK_TARGET_COUNT < total_size:
+        chunk_size *= 2
+    return chunk_size
+
+
+def pinned_chunks(boxes, chunk_size, total_size):
+    """Indexes of the chunks a fill pins: the head of the video and its ftyp and moov boxes"""
+    head_chunks = -(-int(CACHE_HEAD_MB * 1024 * 1024) // chunk_size)
+    head = range(min(head_chunks, -(-total_size // chunk_size)))
+    return sorted(set(head).union(mp4box.box_chunks(boxes, chunk_size, total_size)))
+
+
+def pinned_key(slug):
+    """Digests of the chunks pinned for a title, in index order"""
+    return f"video:{slug}:pinned"
+
+
+class RedisChunkStore:
+    """Content-addressed chunks as Redis keys, shared by every video that contains them.
+
+    Chunks are written on the caller's pipeline so they land with its progress
+    updates. Lookups go by digest; the slug and index only decide the TTL.
+    """
+
+    def prepare(self, slug, total_size, chunk_size):
+        pass
+
+    def store(self, pipe, slug, index, digest, chunk, chunk_size, pinned=False):
+        """Write one chunk, evictable unless `pinned`; fills pin at commit, see pin()"""
+        if pinned:
+            pipe.set(chunk_key(digest), chunk)
+        else:
+            # NX: a copy already stored, possibly pinned as another video's head, is kept as is
+            pipe.set(chunk_key(digest), chunk, ex=CHUNK_TTL_SECONDS, nx=True)
+
+    def fetch(self, slug, indexes, digests, chunk_size):
+        """The chunks for `indexes`, with None for each one not stored"""
+        return redis_client.mget(chunk_keys(digests))
+
+    async def fetch_async(self, slug, indexes, digests, chunk_size):
+        return await get_async_redis().mget(chunk_keys(digests))
+
+    def exists(self, slug, index, digest):
+        return bool(digest) and bool(redis_client.exists(chunk_key(digest)))
+
+    async def exists_async(self, slug, index, digest):
+        return bool(digest) and bool(await get_async_redis().exists(chunk_key(digest)))
+
+    def count(self, slug, indexes, digests):
+        """How many of chunks `indexes` are stored"""
+        present = 0
+        for batch_start in range(0, len(digests), KEY_BATCH):
+            present += redis_client.exists(*chunk_keys(digests[batch_start:batch_start + KEY_BATCH]))
+        return present
+
+    def missing(self, slug, indexes, digests):
+        """The indexes among `indexes` whose chunks are not stored"""
+        pipe = redis_client.pipeline(transaction=False)
+        for key in chunk_keys(digests):
+            pipe.exists(key)
+        return [index for index, present in zip(indexes, pipe.execute()) if not present]
+
+    def pin(self, slug, indexes, digests, chunk_size, total_size):
+        """Keep chunks `indexes` out of eviction, whatever TTL they were stored with, and
+        record them against CACHE_PINNED_MB; unpins the least watched titles if it is exceeded"""
+        digests = [digest for digest in digests if digest]
+        pinned_bytes = sum(min(chunk_size, total_size - index * chunk_size) for index in indexes)
+        pipe = redis_client.pipeline(transaction=False)
+        for digest in digests:
+            pipe.persist(chunk_key(digest))
+        pipe.set(pinned_key(slug), b"".join(digests))
+        pipe.hset(PINNED_TITLES_KEY, slug, pinned_bytes)
+        pipe.execute()
+        self.enforce_pin_budget(keep=slug)
+
+    def is_pinned(self, slug):
+        """Whether a title's pinned chunks are still kept out of eviction"""
+        return bool(redis_client.hexists(PINNED_TITLES_KEY, slug))
+
+    async def is_pinned_async(self, slug):
+        return bool(await get_async_redis().hexists(PINNED_TITLES_KEY, slug))
+
+    def enforce_pin_budget(self, keep=None, max_bytes=CACHE_PINNED_MB * 1024 * 1024):
+        """Unpin titles, least watched first, until the pinned bytes fit in max_bytes.
+
+        Views are counted by name from the meta hash; a title whose meta hash is gone
+        has none and goes first. Among equally watched titles `keep` goes last.
+        """
+        titles = {slug.decode(): int(size) for slug, size in redis_client.hgetall(PINNED_TITLES_KEY).items()}
+        pinned_bytes = sum(titles.values())
+        if pinned_bytes <= max_bytes:
+            return
+
+        slugs = list(titles)
+        pipe = redis_client.pipeline(transaction=False)
+        for slug in slugs:
+            pipe.hget(f"video:{slug}:meta", "original_name")
+        names = pipe.execute()
+        views = redis_demand()
+        ranked = sorted(zip(slugs, names),
+                        key=lambda entry: (views[entry[1].decode()] if entry[1] else -1, entry[0] == keep))
+        for slug, _ in ranked:
+            if pinned_bytes <= max_bytes:
+                break
+            self.unpin(slug)
+            pinned_bytes -= titles[slug]
+            print(f"[~] Unpinned the head of {slug}, pinned chunks are over {max_bytes / (1024 * 1024):.0f} MB")
+
+    def unpin(self, slug):
+        """Give a title's pinned chunks the normal TTL so they can be evicted"""
+        digests = redis_client.get(pinned_key(slug)) or b""
+        self._expire(manifest_digests(digests, range(len(digests) // DIGEST_SIZE)))
+        redis_client.delete(pinned_key(slug))
+        redis_client.hdel(PINNED_TITLES_KEY, slug)
+
+    def release(self, slug, digests):
+        """Let a video's chunks be evicted once it is refilled or replaced.
+
+        Other videos may share the chunks, so they are not deleted: the pinned head
+        chunks get the normal TTL and age out unless something reads them.
+        """
+        self._expire(digests)
+        redis_client.delete(pinned_key(slug))
+        redis_client.hdel(PINNED_TITLES_KEY, slug)
+
+    def _expire(self, digests):
+        digests = [digest for digest in digests if digest]
+        for batch_start in range(0, len(digests), KEY_BATCH):
+            pipe = redis_client.pipeline(transaction=False)
+            for digest in digests[batch_start:batch_start + KEY_BATCH]:
+                pipe.expire(chunk_key(digest), CHUNK_TTL_SECONDS, nx=True)
+            pipe.execute()
+
+    def open_range(self, slug, start, end, chunk_size, total_size):
+        """Redis has no file to hand to sendfile"""
+        return None
+
+
+class DiskChunkStore:
+    """Chunks in one preallocated file per video on local disk.
+
+    Chunk i of a video lives at offset i * chunk_size of {slug}.data, and byte i of
+    {slug}.idx is set once it has been written. Reads slice a shared mmap of the
+    file, so cached bytes come straight from the page cache, and open_range() hands
+    the tail of a file to wsgi.file_wrapper so the server can sendfile() it.
+
+    Files are per video, so digests are not used for lookups here and duplicate
+    uploads each get their own file. Files are evicted oldest first when a fill, or
+    a repair that creates or grows a file, needs room under max_bytes. The disk belongs to one pod: chunks this pod does not have are fetched from S3 and
+    written here the same way evicted Redis chunks are.
+    """
+
+    def __init__(self, directory, max_bytes, open_files=CHUNK_STORE_OPEN_FILES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.open_files = open_files
+        self._maps = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, slug, suffix):
+        return os.path.join(self.directory, f"{slug}.{suffix}")
+
+    def _flags(self, slug, first_chunk, last_chunk):
+        """One byte per chunk first_chunk..last_chunk, non-zero where the chunk is on disk"""
+        count = last_chunk - first_chunk + 1
+        try:
+            with open(self._path(slug, 'idx'), 'rb') as index_file:
+                index_file.seek(first_chunk)
+                flags = index_file.read(count)
+        except FileNotFoundError:
+            flags = b''
+        return flags.ljust(count, b'\0')
+
+    def _map(self, slug):
+        """A read-only view of the video's file, remapped when the file is replaced or grows"""
+        path = self._path(slug, 'data')
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        identity = (st.st_ino, st.st_size)
+        with self._lock:
+            entry = self._maps.get(slug)
+            if entry is not None and entry[0] == identity:
+                self._maps.move_to_end(slug)
+                return entry[1]
+        if not st.st_size:
+            return None
+        with open(path, 'rb') as data_file:
+            # Views already handed out keep the old mapping alive until they are dropped
+            view = memoryview(mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ))
+        with self._lock:
+            self._maps[slug] = (identity, view)
+            while len(self._maps) > self.open_files:
+                self._maps.popitem(last=False)
+        return view
+
+    def prepare(self, slug, total_size, chunk_size):
+        """Create the video's file at its full size, evicting older videos to make room.
+
+        Other workers may have the old file mapped, and truncating a mapped file under
+        them makes their reads fault. So the new files are written beside the old ones
+        and renamed over them, index first, so no chunk of the old file is ever marked
+        present in the new one; existing mappings keep the old inode.
+        """
+        if total_size:
+            self._make_room(total_size)
+
+        def write_index(fd):
+            with open(fd, 'wb', closefd=False) as index_file:
+                index_file.write(bytes(-(-total_size // chunk_size)))
+
+        def allocate(fd):
+            if total_size:
+                try:
+                    os.posix_fallocate(fd, 0, total_size)
+                except OSError:
+                    os.ftruncate(fd, total_size)  # Filesystems without fallocate get a sparse file
+
+        self._install(slug, 'idx', write_index)
+        self._install(slug, 'data', allocate)
+
+    def _install(self, slug, suffix, write):
+        """Write a new {slug}.{suffix} with write(fd) and rename it over the old one"""
+        fd, temp_path = tempfile.mkstemp(prefix=f".{slug}.", suffix=".tmp", dir=self.directory)
+        try:
+            try:
+                os.fchmod(fd, 0o644)
+                write(fd)
+            finally:
+                os.close(fd)
+            os.replace(temp_path, self._path(slug, suffix))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def store(self, pipe, slug, index, digest, chunk, chunk_size, pinned=False):
+        fd = os.open(self._path(slug, 'data'), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            # Repairs on a pod that never filled the video create and grow its file here, not in prepare()
+            grown = index * chunk_size + len(chunk) - os.fstat(fd).st_size
+            if grown > 0:
+                self._make_room(grown, keep=slug)
+            os.pwrite(fd, chunk, index * chunk_size)
+        finally:
+            os.close(fd)
+        # Only mark the chunk present once its bytes are in place
+        fd = os.open(self._path(slug, 'idx'), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            os.pwrite(fd, b'\1', index)
+        finally:
+            os.close(fd)
+
+    def fetch(self, slug, indexes, digests, chunk_size):
+        """Views of the chunks for `indexes` in the mapped file, with None for each one not stored"""
+        flags = self._flags(slug, min(indexes), max(indexes))
+        view = self._map(slug) if any(flags) else None
+        chunks = []
+        for index in indexes:
+            chunk = None
+            if view is not None and flags[index - min(indexes)]:
+                chunk = view[index * chunk_size:(index + 1) * chunk_size] or None
+            chunks.append(chunk)
+        return chunks
+
+    async def fetch_async(self, slug, indexes, digests, chunk_size):
+        # Slicing the mapping does no I/O; pages are read as the server sends them
+        return self.fetch(slug, indexes, digests, chunk_size)
+
+    def exists(self, slug, index, digest):
+        return bool(self._flags(slug, index, index)[0])
+
+    async def exists_async(self, slug, index, digest):
+        return self.exists(slug, index, digest)
+
+    def count(self, slug, indexes, digests):
+        if not indexes:
+            return 0
+        flags = self._flags(slug, min(indexes), max(indexes))
+        return sum(1 for index in indexes if flags[index - min(indexes)])
+
+    def missing(self, slug, indexes, digests):
+        flags = self._flags(slug, min(indexes), max(indexes))
+        return [index for index in indexes if not flags[index - min(indexes)]]
+
+    def pin(self, slug, indexes, digests, chunk_size, total_size):
+        pass  # Whole files are evicted here, never single chunks
+
+    def is_pinned(self, slug):
+        return False
+
+    async def is_pinned_async(self, slug):
+        return False
+
+    def release(self, slug, digests):
+        self.delete(slug)
+
+    def delete(self, slug):
+        for suffix in ('data', 'idx'):
+            try:
+                os.unlink(self._path(slug, suffix))
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._maps.pop(slug, None)
+
+    def open_range(self, slug, start, end, chunk_size, total_size):
+        """The video's file positioned at `start`, if bytes [start, end) are all on disk.
+
+        wsgi.file_wrapper sends to the end of the file, so only ranges that run to
+        the end of the video qualify.
+        """
+        if end != total_size:
+            return None
+        flags = self._flags(slug, start // chunk_size, (end - 1) // chunk_size)
+        if not all(flags):
+            return None
+        try:
+            data_file = open(self._path(slug, 'data'), 'rb')
+        except FileNotFoundError:
+            return None
+        if os.fstat(data_file.fileno()).st_size != total_size:
+            data_file.close()
+            return None
+        data_file.seek(start)
+        return data_file
+
+    def _make_room(self, needed, keep=None):
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.data'):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.name[:-len('.data')]))
+        used = sum(size for _, size, _ in files)
+        for _, size, slug in sorted(files):
+            if used + needed <= self.max_bytes:
+                break
+            if slug == keep:
+                continue
+            self.delete(slug)
+            used -= size
+            print(f"[~] Evicted {slug} from the disk chunk store")
+
+
+class HotChunkCache:
+    """Byte-budgeted LRU of chunks held in this worker, in front of the chunk store.
+
+    Entries are keyed on chunk digest, so a video that is filled again with new
+    content is never served from its old chunks: they stop being looked up and
+    age out. Chunks shared by several videos are held once.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._chunks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, digests):
+        """The cached chunks for `digests`, with None for each one not held"""
+        if not self.max_bytes:
+            return [None] * len(digests)
+        chunks = []
+        with self._lock:
+            for key in digests:
+                chunk = self._chunks.get(key) if key else None
+                if chunk is not None:
+                    self._chunks.move_to_end(key)
+                chunks.append(chunk)
+        return chunks
+
+    def put(self, digest, chunk):
+        if not self.max_bytes or not digest or len(chunk) > self.max_bytes:
+            return
+        key = digest
+        with self._lock:
+            previous = self._chunks.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self._chunks[key] = chunk
+            self.size += len(chunk)
+            while self.size > self.max_bytes:
+                _, evicted = self._chunks.popitem(last=False)
+                self.size -= len(evicted)
+
+    def stats(self):
+        with self._lock:
+            return {"chunks": len(self._chunks), "bytes": self.size, "max_bytes": self.max_bytes}
+
+
+class ByteCounter:
+    """Bytes sent to viewers from each of BYTE_SOURCES, shared by all workers.
+
+    record() only adds to in-process totals, so it is safe on the event loop and in
+    streaming generators; a background thread adds them to the stats:bytes hash.
+    """
+
+    def __init__(self, key=BYTE_STATS_KEY, interval=BYTE_STATS_FLUSH_SECONDS):
+        self.key = key
+        self.interval = interval
+        self._pending = dict.fromkeys(BYTE_SOURCES, 0)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def record(self, memory_bytes=0, store_bytes=0, origin_bytes=0):
+        if not memory_bytes and not store_bytes and not origin_bytes:
+            return
+        metrics.record_served(memory_bytes, store_bytes, origin_bytes)
+        self._start()
+        with self._lock:
+            self._pending["memory"] += memory_bytes
+            self._pending["store"] += store_bytes
+            self._pending["origin"] += origin_bytes
+
+    def stats(self):
+        """Cluster-wide L1, L2 and overall byte hit ratios, including unflushed bytes.
+
+        The L1 ratio is the share of all bytes served from worker memory; the L2
+        ratio is the share of the rest that the chunk store had.
+        """
+        with self._lock:
+            totals = dict(self._pending)
+        try:
+            stored = redis_client.hgetall(self.key)
+        except redis.RedisError:
+            stored = {}
+        for field, value in stored.items():
+            totals[field.decode()] = totals.get(field.decode(), 0) + int(value)
+        served = sum(totals[source] for source in BYTE_SOURCES)
+        below_l1 = totals["store"] + totals["origin"]
+        return {
+            "bytes_from_memory": totals["memory"],
+            "bytes_from_store": totals["store"],
+            "bytes_from_origin": totals["origin"],
+            "l1_hit_ratio": totals["memory"] / served if served else None,
+            "l2_hit_ratio": totals["store"] / below_l1 if below_l1 else None,
+            "byte_hit_ratio": (totals["memory"] + totals["store"]) / served if served else None
+        }
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = dict.fromkeys(BYTE_SOURCES, 0)
+        if not any(pending.values()):
+            return
+        try:
+            pipe = redis_client.pipeline(transaction=False)
+            for field, value in pending.items():
+                if value:
+                    pipe.hincrby(self.key, field, value)
+            pipe.execute()
+        except redis.RedisError:
+            # Keep the counts for the next flush
+            with self._lock:
+                for field, value in pending.items():
+                    self._pending[field] += value
+
+    def _start(self):
+        # Started lazily, and again in a forked worker
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pending = dict.fromkeys(BYTE_SOURCES, 0)
+            self._thread = threading.Thread(target=self._run, name="byte-stats", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+
+if CHUNK_STORE == 'disk':
+    chunk_store = DiskChunkStore(CHUNK_STORE_DIR, int(CHUNK_STORE_MAX_GB * 1024 ** 3))
+else:
+    chunk_store = RedisChunkStore()
+hot_chunks = HotChunkCache(HOT_CHUNK_CACHE_MB * 1024 * 1024)
+byte_counter = ByteCounter()
@@ -0,0 +1,105 @@
+"""How often each title has been watched recently, to decide what to warm into the cache.
+
+Every watch page view adds one to the title's score in an hourly sorted set,
+demand:{YYYYmmddHH} (UTC), which expires once it is more than DEMAND_HOURS old.
+Redis keeps no snapshots (see redis.conf), so the counters start over whenever it
+restarts; the nginx access log, in its video_log format, can stand in for them.
+"""
+import os
+import re
+import urllib.parse
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+import redis
+from redisclient import redis_client, get_async_redis
+
+# How far back demand is counted
+DEMAND_HOURS = int(os.getenv('DEMAND_HOURS', 24))
+# nginx access log read in addition to the Redis counters, skipped if it does not exist
+DEMAND_ACCESS_LOG = os.getenv('DEMAND_ACCESS_LOG', '/var/log/nginx/video_access.log')
+
+# log_format video_log '[$time_local] $remote_addr "$request" Status:$status Cache:$upstream_cache_status Range:"$http_range"'
+VIDEO_LOG_LINE = re.compile(
+    r'\[(?P<time>[^\]]+)\] \S+ "(?:GET|HEAD) /(?:videos|watch|stream)/(?P<path>[^ ?"]+)[^"]*" '
+    r'Status:(?P<status>\d+) Cache:\S* Range:"(?P<range>[^"]*)"')
+
+
+def demand_key(hour):
+    return f"demand:{hour:%Y%m%d%H}"
+
+
+def _record(pipe, name):
+    key = demand_key(datetime.now(timezone.utc))
+    pipe.zincrby(key, 1, name)
+    pipe.expire(key, (DEMAND_HOURS + 1) * 3600)
+
+
+def record_view(name):
+    """Count one view of the title `name`; a failure is logged, never raised"""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        _record(pipe, name)
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"[!] Could not count a view of {name}: {e}")
+
+
+async def record_view_async(name):
+    try:
+        pipe = get_async_redis().pipeline(transaction=False)
+        _record(pipe, name)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"[!] Could not count a view of {name}: {e}")
+
+
+def redis_demand(hours=DEMAND_HOURS):
+    """Views per title over the last `hours` hours from the Redis counters"""
+    now = datetime.now(timezone.utc)
+    pipe = redis_client.pipeline(transaction=False)
+    for hour in range(hours):
+        pipe.zrange(demand_key(now - timedelta(hours=hour)), 0, -1, withscores=True)
+    views = Counter()
+    for entries in pipe.execute():
+        for name, score in entries:
+            views[name.decode()] += int(score)
+    return views
+
+
+def access_log_demand(path, hours=DEMAND_HOURS):
+    """Views per title over the last `hours` hours of an nginx access log in video_log format.
+
+    A player fetches a video in many range requests, so only successful requests
+    without a range, or for one starting at byte 0, count as a view.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=hours)
+    views = Counter()
+    with open(path, errors='replace') as log:
+        for line in log:
+            match = VIDEO_LOG_LINE.match(line)
+            if not match or not match['status'].startswith('2'):
+                continue
+            if match['range'] and not match['range'].startswith('bytes=0-'):
+                continue
+            try:
+                when = datetime.strptime(match['time'], '%d/%b/%Y:%H:%M:%S %z')
+            except ValueError:
+                continue
+            if when >= cutoff:
+                views[urllib.parse.unquote(match['path'])] += 1
+    return views
+
+
+def recent_demand(hours=DEMAND_HOURS, access_log=DEMAND_ACCESS_LOG):
+    """Views per title from the Redis counters plus the access log, if there is one"""
+    views = Counter()
+    try:
+        views.update(redis_demand(hours))
+    except redis.RedisError as e:
+        print(f"[!] Could not read view counters: {e}")
+    if access_log and os.path.exists(access_log):
+        try:
+            views.update(access_log_demand(access_log, hours))
+        except OSError as e:
+            print(f"[!] Could not read access log {access_log}: {e}")
+    return views
@@ -0,0 +1,102 @@
+import heapq
+import itertools
+import os
+import threading
+from redispython import store_video_in_redis
+
+# Concurrent cache fills per process, and how many distinct videos may wait for a worker
+FILL_WORKERS = int(os.getenv('FILL_WORKERS', 4))
+FILL_QUEUE_LIMIT = int(os.getenv('FILL_QUEUE_LIMIT', 100))
+
+
+class FillScheduler:
+    """Bounded pool of cache-fill workers fed from a priority queue.
+
+    Each video is queued at most once; asking for a queued video again bumps its
+    request count, and the worker always picks the most requested video next.
+    When FILL_QUEUE_LIMIT videos are already waiting, new videos are rejected
+    (they are simply streamed from S3 without being cached).
+    """
+
+    def __init__(self, fill, workers=FILL_WORKERS, max_queued=FILL_QUEUE_LIMIT):
+        self._fill = fill
+        self.workers = workers
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._requests = {}  # video_name -> request count while queued
+        self._heap = []      # (-request count, seq, video_name); outdated entries are skipped
+        self._seq = itertools.count()
+        self._in_flight = set()
+        self._threads = []
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+
+    def submit(self, video_name):
+        """Queue a fill for video_name; returns False if the queue is full"""
+        with self._cond:
+            self._start_workers()
+            if video_name in self._in_flight:
+                return True
+            if video_name not in self._requests and len(self._requests) >= self.max_queued:
+                self.rejected += 1
+                return False
+
+            count = self._requests.get(video_name, 0) + 1
+            self._requests[video_name] = count
+            heapq.heappush(self._heap, (-count, next(self._seq), video_name))
+            self._cond.notify()
+            return True
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queue_depth": len(self._requests),
+                "queue_limit": self.max_queued,
+                "in_flight": len(self._in_flight),
+                "in_flight_videos": sorted(self._in_flight),
+                "queued_videos": sorted(self._requests, key=self._requests.get, reverse=True),
+                "rejected": self.rejected,
+                "completed": self.completed,
+                "failed": self.failed
+            }
+
+    def _start_workers(self):
+        # Started lazily so that a pre-forking server starts them in each worker process
+        if self._threads:
+            return
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f"cache-fill-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _next_job(self):
+        with self._cond:
+            while True:
+                while self._heap:
+                    neg_count, _, video_name = heapq.heappop(self._heap)
+                    if self._requests.get(video_name) == -neg_count:
+                        del self._requests[video_name]
+                        self._in_flight.add(video_name)
+                        return video_name
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            video_name = self._next_job()
+            failed = False
+            try:
+                self._fill(video_name)
+            except Exception as e:
+                print(f"[!] Cache fill for {video_name} crashed: {e}")
+                failed = True
+            with self._cond:
+                self._in_flight.discard(video_name)
+                if failed:
+                    self.failed += 1
+                else:
+                    self.completed += 1
+
+
+fill_scheduler = FillScheduler(store_video_in_redis)
@@ -0,0 +1,65 @@
+"""Production gunicorn settings, tunable through GUNICORN_* environment variables.
+
+    gunicorn -c gunicorn.conf.py
+
+By default each worker runs the asyncio front end (asgi:application) under uvicorn,
+through the uvicorn-worker package, so long video streams are multiplexed on the
+event loop. With
+GUNICORN_WORKER_CLASS=gthread the Flask app is served from wsgi:application and
+each stream holds one of the worker's threads instead.
+"""
+import glob
+import multiprocessing
+import os
+import tempfile
+
+ASYNC_WORKER_CLASS = 'uvicorn_worker.UvicornWorker'
+
+# Import paths below are relative to this directory, wherever gunicorn is started from
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', ASYNC_WORKER_CLASS)
+wsgi_app = 'asgi:application' if worker_class == ASYNC_WORKER_CLASS else 'wsgi:application'
+
+# An event-loop worker uses a whole core; thread workers spend most of their time
+# waiting on Redis and S3, so they run more processes and many threads each
+if worker_class == ASYNC_WORKER_CLASS:
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count()))
+else:
+    workers = int(os.getenv('GUNICORN_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+# Concurrent requests per gthread worker; every open stream holds one
+threads = int(os.getenv('GUNICORN_THREADS', 32))
+
+# Import the app once in the master so workers fork with it already loaded. Redis,
+# origin connections and background threads are created lazily in each worker.
+preload_app = True
+
+# Recycle workers after this many requests (with jitter so they do not restart
+# together) and give open streams time to finish when a worker is stopped
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 120))
+# Seconds a worker may go without notifying the master before it is restarted
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+
+accesslog = os.getenv('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+# Workers keep their Prometheus samples in files here so /metrics can add them up
+# across workers. Set before the app is preloaded, since metrics reads it on import.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'cdn-metrics'))
+os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+
+def on_starting(server):
+    # Samples left by an earlier run would be counted again
+    for path in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges; its counters and histograms keep counting
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,116 @@
+"""Prometheus metrics for capacity planning, served from /metrics.
+
+Under gunicorn, gunicorn.conf.py points PROMETHEUS_MULTIPROC_DIR at a directory
+where every worker keeps its samples in small memory-mapped files, so recording a
+sample is an in-process write with no locks shared between workers or round trips,
+and /metrics, whichever worker answers it, adds up the files of all of them.
+Without that variable (python app.py, a single uvicorn) the samples stay in memory.
+"""
+import os
+import resource
+import threading
+import time
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+                               generate_latest, multiprocess)
+
+# How often each worker refreshes its resident memory gauge
+METRICS_MEMORY_SECONDS = float(os.getenv('METRICS_MEMORY_SECONDS', 15))
+
+# Redis round trips are sub-millisecond when healthy; S3 needs up to seconds
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+FILL_DURATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+FILL_THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 25, 50, 100, 250, 500, 1000))
+
+watch_requests = Counter(
+    'cdn_watch_requests_total', "Watch page requests by whether the video was cached", ['result'])
+stream_requests = Counter(
+    'cdn_stream_requests_total',
+    "Video responses by where their bytes came from: hit (all cached), partial (some from S3), miss (all from S3)",
+    ['result'])
+bytes_served = Counter(
+    'cdn_bytes_served_total', "Video bytes sent to viewers from worker memory, the chunk store or S3", ['source'])
+redis_latency = Histogram(
+    'cdn_redis_latency_seconds', "Redis commands by name, including the wait for a pooled connection; "
+    "a pipeline is one PIPELINE round trip", ['operation'], buckets=LATENCY_BUCKETS)
+origin_latency = Histogram(
+    'cdn_origin_latency_seconds', "S3 requests until their response headers arrive (listing pages: the whole body)",
+    ['operation'], buckets=LATENCY_BUCKETS)
+fill_duration = Histogram(
+    'cdn_fill_duration_seconds', "Cache fills from the first origin byte until they were committed or abandoned",
+    ['result'], buckets=FILL_DURATION_BUCKETS)
+fill_bytes = Counter('cdn_fill_bytes_total', "Bytes written to the chunk store by cache fills", ['result'])
+fill_throughput = Histogram(
+    'cdn_fill_throughput_bytes_per_second', "Bytes per second written by each committed cache fill",
+    buckets=FILL_THROUGHPUT_BUCKETS)
+active_streams = Gauge(
+    'cdn_active_streams', "Video responses being streamed through Python right now",
+    ['source'], multiprocess_mode='livesum')
+worker_memory = Gauge(
+    'cdn_worker_resident_bytes', "Resident memory of each worker process", multiprocess_mode='liveall')
+
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+
+def record_served(memory_bytes=0, store_bytes=0, origin_bytes=0):
+    """Count one finished video response and the bytes it sent from each source"""
+    if memory_bytes:
+        bytes_served.labels('memory').inc(memory_bytes)
+    if store_bytes:
+        bytes_served.labels('store').inc(store_bytes)
+    if origin_bytes:
+        bytes_served.labels('origin').inc(origin_bytes)
+    if not origin_bytes:
+        stream_requests.labels('hit').inc()
+    elif memory_bytes or store_bytes:
+        stream_requests.labels('partial').inc()
+    else:
+        stream_requests.labels('miss').inc()
+    _start_sampler()
+
+
+def record_fill(result, elapsed, bytes_written):
+    """Record a cache fill that was `result` ('committed' or 'abandoned') after `elapsed` seconds"""
+    fill_duration.labels(result).observe(elapsed)
+    fill_bytes.labels(result).inc(bytes_written)
+    if result == 'committed' and elapsed > 0:
+        fill_throughput.observe(bytes_written / elapsed)
+
+
+def resident_bytes():
+    """This process's resident set size; the peak where /proc is not available"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _start_sampler():
+    """Refresh this worker's memory gauge from a background thread, started once per process"""
+    global _sampler_pid
+    if _sampler_pid == os.getpid():
+        return
+    with _sampler_lock:
+        if _sampler_pid == os.getpid():
+            return
+        _sampler_pid = os.getpid()
+        threading.Thread(target=_sample_memory, daemon=True).start()
+
+
+def _sample_memory():
+    while True:
+        worker_memory.set(resident_bytes())
+        time.sleep(METRICS_MEMORY_SECONDS)
+
+
+def render():
+    """The text exposition of every metric, summed across workers in multiprocess mode"""
+    _start_sampler()
+    worker_memory.set(resident_bytes())
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry)
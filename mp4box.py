@@ -0,0 +1,164 @@
+"""Top-level box layout of MP4/QuickTime files, read while they stream through a fill.
+
+An MP4 file is a sequence of boxes, each starting with a 32-bit size and a 4-byte
+type (a size of 1 means a 64-bit size follows, 0 means the box runs to the end of
+the file). Players need `moov`, the index of the whole file, before they can show
+a frame; many encoders write it after the media data in `mdat`, so the player's
+first range request only finds out where to look next. Knowing the layout lets the
+cache keep the chunks holding `ftyp` and `moov` resident and have them ready for
+that second request.
+"""
+import json
+import struct
+
+# Boxes a file may start with; anything else is not treated as MP4
+FIRST_BOX_TYPES = {b'ftyp', b'styp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pdin', b'uuid'}
+# Boxes whose chunks stay resident
+PINNED_BOX_TYPES = ('ftyp', 'moov')
+# Top-level boxes recorded per video; fragmented files have one moof/mdat pair per
+# fragment, and only the leading boxes matter for startup
+MAX_BOXES = 64
+# Bytes of the start of moov kept to read the duration from mvhd
+MVHD_BYTES = 128
+
+
+class BoxScanner:
+    """Finds the top-level boxes of a file fed to it in order, without buffering the file.
+
+    feed() takes consecutive blocks starting at `position`; only box headers, and
+    the first MVHD_BYTES of moov, are copied. `boxes` lists (type, offset, size) with
+    size None for a box that runs to the end of the file. `valid` turns False as
+    soon as the data does not look like MP4.
+    """
+
+    def __init__(self, position=0):
+        self.position = position
+        self.next_box = position
+        self.boxes = []
+        self.valid = True
+        self.complete = False
+        self._header = bytearray()
+        self._moov_start = None
+        self._moov_head = bytearray()
+
+    def feed(self, data):
+        start = self.position
+        self.position += len(data)
+        self._capture(data, start)
+        while self.valid and not self.complete and self.next_box < self.position:
+            offset = self.next_box + len(self._header) - start
+            needed = (16 if self._header[:4] == b'\0\0\0\1' else 8) - len(self._header)
+            self._header += data[offset:offset + needed]
+            if len(self._header) < 8 or (self._header[:4] == b'\0\0\0\1' and len(self._header) < 16):
+                if offset + needed > len(data):
+                    return  # The rest of the header is in the next block
+                continue  # A 64-bit size follows
+            self._read_header()
+            self._capture(data, start)
+
+    def _read_header(self):
+        size, box_type = struct.unpack('>I4s', self._header[:8])
+        header_size = 8
+        if size == 1:
+            size, header_size = struct.unpack('>Q', self._header[8:16])[0], 16
+        self._header = bytearray()
+        if (not all(0x20 <= c < 0x7f for c in box_type) or 0 < size < header_size
+                or (not self.boxes and box_type not in FIRST_BOX_TYPES)):
+            self.valid = False
+            return
+
+        self.boxes.append((box_type.decode('latin-1'), self.next_box, size or None))
+        if box_type == b'moov' and self._moov_start is None:
+            self._moov_start = self.next_box + header_size
+        if size == 0 or len(self.boxes) >= MAX_BOXES:
+            self.complete = True
+            return
+        self.next_box += size
+
+    def _capture(self, data, start):
+        if self._moov_start is None or len(self._moov_head) >= MVHD_BYTES:
+            return
+        offset = self._moov_start + len(self._moov_head) - start
+        if 0 <= offset < len(data):
+            self._moov_head += data[offset:offset + MVHD_BYTES - len(self._moov_head)]
+
+    def layout(self, total_size):
+        """The boxes found, if they tile a file of total_size bytes, or None"""
+        if not self.valid or not self.boxes:
+            return None
+        if not self.complete and self.next_box != total_size:
+            return None
+        return self.boxes
+
+    def duration(self):
+        """The movie's duration in seconds from moov/mvhd, or None"""
+        return mvhd_duration(bytes(self._moov_head))
+
+
+def mvhd_duration(moov_head):
+    """Duration in seconds from the first bytes of moov's body, if they start with mvhd"""
+    if len(moov_head) < 8 or moov_head[4:8] != b'mvhd':
+        return None
+    body = moov_head[8:]
+    try:
+        if body[0] == 1:
+            timescale, duration = struct.unpack('>IQ', body[20:32])
+        else:
+            timescale, duration = struct.unpack('>II', body[12:20])
+    except (IndexError, struct.error):
+        return None
+    return duration / timescale if timescale else None
+
+
+def walk_boxes(read, total_size):
+    """Scan a stored file of total_size bytes reading only its box headers, through read(offset, size).
+
+    Returns the BoxScanner, as if the whole file had been fed to it.
+    """
+    scanner = BoxScanner()
+    while scanner.valid and not scanner.complete and scanner.next_box < total_size:
+        position = scanner.next_box + len(scanner._header)
+        if position >= total_size:
+            scanner.valid = False  # Header cut short by the end of the file
+            break
+        scanner.position = position
+        scanner.feed(read(position, min(16, total_size - position)))
+    scanner.position = total_size
+    if scanner._moov_start is not None and scanner._moov_start < total_size:
+        scanner._moov_head = bytearray(read(scanner._moov_start,
+                                            min(MVHD_BYTES, total_size - scanner._moov_start)))
+    return scanner
+
+
+def encode_boxes(boxes):
+    return json.dumps(boxes, separators=(',', ':'))
+
+
+def decode_boxes(meta):
+    """The box layout recorded in a meta hash, or an empty list"""
+    try:
+        return [tuple(box) for box in json.loads(meta.get("boxes") or "[]")]
+    except ValueError:
+        return []
+
+
+def box_chunks(boxes, chunk_size, total_size, types=PINNED_BOX_TYPES):
+    """Indexes of the chunks holding any of the boxes of `types`"""
+    indexes = set()
+    for box_type, offset, size in boxes:
+        if box_type in types:
+            end = offset + size if size else total_size
+            indexes.update(range(offset // chunk_size, (end - 1) // chunk_size + 1))
+    return sorted(indexes)
+
+
+def tail_after_media(boxes, total_size):
+    """Offset of the boxes after the first mdat when moov is not before it, or None"""
+    for box_type, offset, size in boxes:
+        if box_type == 'moov':
+            return None
+        if box_type == 'mdat':
+            if not size or offset + size >= total_size:
+                return None
+            return offset + size
+    return None
@@ -0,0 +1,142 @@
+import os
+import threading
+import time
+import httpx
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Hosts kept in the pool, and keep-alive connections kept per host
+ORIGIN_POOL_HOSTS = int(os.getenv('ORIGIN_POOL_HOSTS', 10))
+ORIGIN_POOL_SIZE = int(os.getenv('ORIGIN_POOL_SIZE', 32))
+ORIGIN_CONNECT_TIMEOUT = float(os.getenv('ORIGIN_CONNECT_TIMEOUT', 5))
+ORIGIN_READ_TIMEOUT = float(os.getenv('ORIGIN_READ_TIMEOUT', 30))
+# Retries for failed connects and 502/503/504, sleeping backoff * 2^n between tries
+ORIGIN_RETRIES = int(os.getenv('ORIGIN_RETRIES', 3))
+ORIGIN_BACKOFF_FACTOR = float(os.getenv('ORIGIN_BACKOFF_FACTOR', 0.3))
+# 'slice': byte ranges are requested from the origin as whole slices of a video's chunk
+# size, aligned to it, so a cache in front of the origin that keys on the Range header
+# (the nginx tier does) sees one key per slice instead of one per player request.
+# 'exact': just the bytes needed.
+ORIGIN_RANGE_MODE = os.getenv('ORIGIN_RANGE_MODE', 'slice')
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_async_client = None
+
+
+def _build_session():
+    retry = Retry(
+        total=ORIGIN_RETRIES,
+        backoff_factor=ORIGIN_BACKOFF_FACTOR,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False  # Hand the last response back; callers check the status
+    )
+    adapter = HTTPAdapter(pool_connections=ORIGIN_POOL_HOSTS, pool_maxsize=ORIGIN_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """The process-wide origin session; rebuilt after a fork so workers never share sockets"""
+    global _session, _session_pid
+    if _session_pid != os.getpid():
+        with _session_lock:
+            if _session_pid != os.getpid():
+                _session = _build_session()
+                _session_pid = os.getpid()
+    return _session
+
+
+def request_operation(headers, params):
+    """How a request is labelled in the latency metrics: listing page, byte range or whole stream"""
+    if params:
+        return 'listing'
+    if headers and 'Range' in headers:
+        return 'range'
+    return 'stream'
+
+
+def upstream_ranges(start, end, slice_size):
+    """The inclusive (first, last) byte ranges to request for the bytes [start, end) of a video.
+
+    In slice mode that is every slice_size slice the bytes touch, the last one
+    possibly running past the end of the file, which origins clip.
+    """
+    if ORIGIN_RANGE_MODE != 'slice' or not slice_size:
+        return [(start, end - 1)]
+    return [(index * slice_size, (index + 1) * slice_size - 1)
+            for index in range(start // slice_size, (end - 1) // slice_size + 1)]
+
+
+def get(url, **kwargs):
+    """GET from the origin through the shared keep-alive pool.
+
+    Streamed responses go back to the pool only once fully read or closed, so
+    callers should close() them when they stop early.
+    """
+    kwargs.setdefault('timeout', (ORIGIN_CONNECT_TIMEOUT, ORIGIN_READ_TIMEOUT))
+    operation = request_operation(kwargs.get('headers'), kwargs.get('params'))
+    started = time.perf_counter()
+    try:
+        return get_session().get(url, **kwargs)
+    finally:
+        metrics.origin_latency.labels(operation).observe(time.perf_counter() - started)
+
+
+class TimedAsyncTransport(httpx.AsyncBaseTransport):
+    """Records the latency of each request until its response headers arrive"""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        operation = request_operation(request.headers, request.url.params)
+        started = time.perf_counter()
+        try:
+            return await self.transport.handle_async_request(request)
+        finally:
+            metrics.origin_latency.labels(operation).observe(time.perf_counter() - started)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def get_async_client():
+    """The asyncio origin client for the ASGI front end, with the same pool size and timeouts.
+
+    httpx only retries failed connects, not 5xx responses.
+    """
+    global _async_client
+    if _async_client is None:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ORIGIN_POOL_HOSTS * ORIGIN_POOL_SIZE,
+                                max_keepalive_connections=ORIGIN_POOL_SIZE),
+            timeout=httpx.Timeout(ORIGIN_READ_TIMEOUT, connect=ORIGIN_CONNECT_TIMEOUT),
+            transport=TimedAsyncTransport(httpx.AsyncHTTPTransport(retries=ORIGIN_RETRIES))
+        )
+    return _async_client
+
+
+def connection_stats():
+    """Per-host request and connection counts for the pools currently held"""
+    stats = {}
+    adapter = get_session().get_adapter('http://')
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host = f"{pool.scheme}://{pool.host}:{pool.port}"
+        entry = stats.setdefault(host, {"requests": 0, "connections_opened": 0})
+        entry["requests"] += pool.num_requests
+        entry["connections_opened"] += pool.num_connections
+    for entry in stats.values():
+        entry["connections_reused"] = max(entry["requests"] - entry["connections_opened"], 0)
+    return stats
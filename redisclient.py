@@ -0,0 +1,148 @@
+import os
+import threading
+import time
+import redis
+import redis.asyncio
+import metrics
+
+REDIS_HOST = os.environ['REDIS_HOST']
+REDIS_PORT = int(os.environ['REDIS_PORT'])
+REDIS_USER = os.environ['REDIS_USER']
+REDIS_PASSWORD = os.environ['REDIS_PASSWORD']
+# Connections per worker process; callers wait up to REDIS_POOL_TIMEOUT for a free one
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
+# Idle connections are PINGed before reuse once they have been idle this long
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', 30))
+# After a connection failure, Redis is skipped and re-probed at most this often
+REDIS_RETRY_SECONDS = float(os.getenv('REDIS_RETRY_SECONDS', 5))
+
+# Shared by the threaded pool and the asyncio pool
+POOL_SETTINGS = dict(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    db=0,
+    username=REDIS_USER,
+    password=REDIS_PASSWORD,
+    max_connections=REDIS_MAX_CONNECTIONS,
+    timeout=REDIS_POOL_TIMEOUT,
+    health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    socket_connect_timeout=5,
+    socket_keepalive=True
+)
+
+
+class TimedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return super().execute(raise_on_error)
+        finally:
+            metrics.redis_latency.labels('PIPELINE').observe(time.perf_counter() - started)
+
+
+class TimedRedis(redis.StrictRedis):
+    """A client that records the latency of every command, and of every pipeline as one round trip"""
+
+    def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            metrics.redis_latency.labels(args[0]).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class TimedAsyncPipeline(redis.asyncio.client.Pipeline):
+    async def execute(self, raise_on_error=True):
+        started = time.perf_counter()
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            metrics.redis_latency.labels('PIPELINE').observe(time.perf_counter() - started)
+
+
+class TimedAsyncRedis(redis.asyncio.StrictRedis):
+    """The asyncio counterpart of TimedRedis"""
+
+    async def execute_command(self, *args, **options):
+        started = time.perf_counter()
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            metrics.redis_latency.labels(args[0]).observe(time.perf_counter() - started)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return TimedAsyncPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+# One pool per process: redis-py resets it in the child after a fork
+redis_pool = redis.BlockingConnectionPool(**POOL_SETTINGS)
+
+# Binary chunks, so no decode_responses; connections are made lazily on first use
+redis_client = TimedRedis(connection_pool=redis_pool)
+
+_async_client = None
+_down_until = 0.0
+_state_lock = threading.Lock()
+
+
+def mark_redis_down(error):
+    """Record a connection failure so callers skip Redis until the next probe"""
+    global _down_until
+    with _state_lock:
+        if not _down_until:
+            print(f"[!] Redis connection failed - continuing without Redis: {error}")
+        _down_until = time.monotonic() + REDIS_RETRY_SECONDS
+
+
+def get_async_redis():
+    """The asyncio client for the ASGI front end, created on first use in its event loop"""
+    global _async_client
+    if _async_client is None:
+        pool = redis.asyncio.BlockingConnectionPool(**POOL_SETTINGS)
+        _async_client = TimedAsyncRedis(connection_pool=pool)
+    return _async_client
+
+
+def redis_marked_down():
+    """Whether a connection failure has been reported and not yet recovered from"""
+    return bool(_down_until)
+
+
+def redis_available():
+    """Whether Redis should be used right now.
+
+    Redis is assumed up until a failure is reported with mark_redis_down(); after
+    that it is re-probed with PING at most every REDIS_RETRY_SECONDS instead of
+    being disabled for the rest of the process.
+    """
+    global _down_until
+    if not _down_until:
+        return True
+    if time.monotonic() < _down_until:
+        return False
+    try:
+        redis_client.ping()
+    except redis.RedisError as e:
+        mark_redis_down(e)
+        return False
+    with _state_lock:
+        _down_until = 0.0
+    print("[✓] Redis connection restored")
+    return True
+
+
+def pool_stats():
+    """Utilisation of this process's Redis connection pool"""
+    idle = sum(1 for connection in list(redis_pool.pool.queue) if connection is not None)
+    created = len(redis_pool._connections)
+    return {
+        "max_connections": redis_pool.max_connections,
+        "created": created,
+        "in_use": created - idle,
+        "idle": idle,
+        "available": not _down_until
+    }
@@ -1,40 +1,489 @@
 import redis
-import requests
+import origin
 import urllib.parse
 import re
 import os
+import queue
+import threading
+import time
+import uuid
+import hashlib
+from redisclient import redis_client, redis_available, mark_redis_down
+import metrics
+import mp4box
+from catalogue import catalogue
+from chunkstore import (chunk_store, byte_counter, chunk_digest, chunk_size_for, digests_key,
+                        manifest_digests, pinned_chunks, DIGEST_SIZE, CHUNK_TTL_SECONDS)
 
 # Get environment variables with fallback defaults
 VIDEO_SERVER_HOST = os.environ['VIDEO_SERVER_HOST']
-REDIS_HOST = os.environ['REDIS_HOST']
-REDIS_PORT = int(os.environ['REDIS_PORT'])
-REDIS_USER = os.environ['REDIS_USER']
-REDIS_PASSWORD = os.environ['REDIS_PASSWORD']
-CHUNK_SIZE = 1024 * 1024  # 1MB
-
-# Redis client setup with error handling
-try:
-    redis_client = redis.StrictRedis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=0,
-        username=REDIS_USER,
-        password=REDIS_PASSWORD,
-        decode_responses=False  # Binary chunks
-    )
-    redis_client.ping()
-    print("[✓] Redis connection successful in redispython")
-except redis.ConnectionError:
-    print("[!] Redis connection failed in redispython")
-    redis_client = None
+# Chunks written per pipeline flush, and flushes allowed to queue up behind the writer
+INGEST_BATCH_CHUNKS = int(os.getenv('INGEST_BATCH_CHUNKS', 4))
+INGEST_MAX_PENDING_BATCHES = int(os.getenv('INGEST_MAX_PENDING_BATCHES', 2))
+# Single-flight fill lock lifetime; the owner renews it every third of this
+FILL_LOCK_TTL_MS = int(os.getenv('FILL_LOCK_TTL_MS', 30000))
+# Largest tail after mdat (normally just moov) fetched ahead of the sequential fill
+MOOV_AHEAD_MAX_MB = float(os.getenv('MOOV_AHEAD_MAX_MB', 64))
 
 def slugify(name):
-    base, ext = name.rsplit(".", 1)
+    """The key a title is cached under; the readers import it so they look up what the fill stored"""
+    base, dot, ext = name.rpartition(".")
+    if not dot:
+        base, ext = name, ""
     base = re.sub(r'\W+', '_', base)
-    return f"{base}.{ext}"
+    # Names that differ only in punctuation must not share a cache entry
+    digest = hashlib.blake2b(name.encode(), digest_size=4).hexdigest()
+    return f"{base}.{digest}.{ext}" if dot else f"{base}.{digest}"
+
+# Only the owner (matching token) may renew or release a fill lock; a renewal also
+# renews the keys after the lock (the fill's progress hash)
+EXTEND_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    for i = 2, #KEYS do
+        redis.call('pexpire', KEYS[i], ARGV[2])
+    end
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+def iter_fixed_chunks(stream, chunk_size):
+    """Re-slice an iterable of byte blocks into exact chunk_size pieces (the last may be shorter)"""
+    buffer = bytearray()
+    for data in stream:
+        if not data:
+            continue
+        buffer.extend(data)
+        while len(buffer) >= chunk_size:
+            yield bytes(buffer[:chunk_size])
+            del buffer[:chunk_size]
+    if buffer:
+        yield bytes(buffer)
+
+class PipelinedChunkWriter:
+    """Writes the chunks of one video to Redis from a background thread, in non-transactional pipelines.
+
+    write() groups chunks into batches of batch_chunks and hands them to the writer
+    thread, so reading from the origin overlaps with Redis writes. At most max_pending
+    batches wait in the queue; beyond that write() blocks, which bounds memory. With
+    block=False a full queue makes write() drop the chunk and return False instead,
+    and every later write is refused too, so the stored chunks stay contiguous.
+
+    Chunks must be written in index order, starting at first_chunk. Each flush
+    appends the chunks' digests to video:{slug}:digests. If progress_key
+    is given, each flush also records how many leading chunks are stored there and
+    announces the count on notify_channel, so read-through viewers can wait for the
+    chunks they need.
+    """
+
+    def __init__(self, slug, chunk_size, progress_key=None, notify_channel=None, first_chunk=0, block=True,
+                 batch_chunks=INGEST_BATCH_CHUNKS, max_pending=INGEST_MAX_PENDING_BATCHES):
+        self.slug = slug
+        self.chunk_size = chunk_size
+        self.progress_key = progress_key
+        self.notify_channel = notify_channel
+        self.block = block
+        self.batch_chunks = batch_chunks
+        self.chunks_stored = first_chunk
+        self.bytes_stored = first_chunk * chunk_size
+        self.overflowed = False
+        self.error = None
+        self._batch = []
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self, index, digest, chunk):
+        """Queue one chunk; returns False if a non-blocking writer had to drop it"""
+        if self.error:
+            raise self.error
+        if self.overflowed:
+            return False
+        self._batch.append((index, digest, chunk))
+        if len(self._batch) >= self.batch_chunks:
+            try:
+                self._queue.put(self._batch, block=self.block)
+            except queue.Full:
+                self.overflowed = True
+                return False
+            finally:
+                self._batch = []
+        return True
+
+    def close(self):
+        """Flush the remaining chunks and wait for the writer; re-raises a write error"""
+        if self._batch and not self.overflowed:
+            self._queue.put(self._batch)
+            self._batch = []
+        self._queue.put(None)
+        self._thread.join()
+        if self.error:
+            raise self.error
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                return
+            if self.error:
+                continue  # Keep draining so the producer never blocks on a dead writer
+            try:
+                pipe = redis_client.pipeline(transaction=False)
+                for index, digest, chunk in batch:
+                    chunk_store.store(pipe, self.slug, index, digest, chunk, self.chunk_size)
+                pipe.setrange(digests_key(self.slug), batch[0][0] * DIGEST_SIZE,
+                              b"".join(digest for _, digest, _ in batch))
+                chunks_stored = self.chunks_stored + len(batch)
+                bytes_stored = self.bytes_stored + sum(len(chunk) for _, _, chunk in batch)
+                if self.progress_key:
+                    pipe.hset(self.progress_key, mapping={
+                        "chunks_stored": chunks_stored,
+                        "bytes_stored": bytes_stored
+                    })
+                    pipe.pexpire(self.progress_key, FILL_LOCK_TTL_MS)
+                if self.notify_channel:
+                    pipe.publish(self.notify_channel, chunks_stored)
+                pipe.execute()
+                self.chunks_stored, self.bytes_stored = chunks_stored, bytes_stored
+            except Exception as e:
+                self.error = e
+
+class FillLock:
+    """Cluster-wide single-flight lock on filling one video.
+
+    Acquired with SET NX PX on video:{slug}:filling (or on `key`, for other jobs that
+    must only run once at a time) and kept alive by a heartbeat thread. If a renewal
+    finds the lock gone or owned by someone else, `lost` is set and the fill should
+    stop writing.
+
+    A fill lock also starts video:{slug}:progress, without an expected size until the
+    fill hears back from S3, and the heartbeat keeps it alive with the lock, so a fill
+    that stalls (a paused viewer's tee) still shows its progress to readers.
+    """
+
+    def __init__(self, slug, ttl_ms=FILL_LOCK_TTL_MS, key=None):
+        self.key = key or f"video:{slug}:filling"
+        self.progress_key = None if key else f"video:{slug}:progress"
+        self.token = uuid.uuid4().hex
+        self.ttl_ms = ttl_ms
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def acquire(self):
+        if not redis_client.set(self.key, self.token, nx=True, px=self.ttl_ms):
+            return False
+        if self.progress_key:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.hset(self.progress_key, "started_at", time.time())
+            pipe.pexpire(self.progress_key, self.ttl_ms)
+            pipe.execute()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def release(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        try:
+            redis_client.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+        except redis.RedisError as e:
+            print(f"[!] Could not release {self.key}, it will expire on its own: {e}")
+
+    def _beat(self):
+        while not self._stop.wait(self.ttl_ms / 3000):
+            try:
+                keys = [self.key, self.progress_key] if self.progress_key else [self.key]
+                renewed = redis_client.eval(EXTEND_LOCK_SCRIPT, len(keys), *keys, self.token, self.ttl_ms)
+            except redis.RedisError as e:
+                print(f"[!] Fill lock heartbeat failed for {self.key}: {e}")
+                continue
+            if not renewed:
+                print(f"[!] Lost fill lock {self.key}")
+                self.lost.set()
+                return
+
+def is_fill_in_progress(slug):
+    return redis_available() and bool(redis_client.exists(f"video:{slug}:filling"))
+
+def _is_stored(slug):
+    # Chunks evicted since are fetched back by readers, so a manifest for the current ETag is enough
+    manifest, original_name, etag = redis_client.hmget(f"video:{slug}:meta", "manifest", "original_name", "etag")
+    if not manifest:
+        return False
+    return catalogue.is_current((original_name or b"").decode(), (etag or b"").decode())
+
+def origin_total_size(response):
+    """Full size of the video behind an origin response (200 or 206), or 0 if unknown"""
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code == 206 and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        return int(total) if total.isdigit() else 0
+    return int(response.headers.get('Content-Length', 0))
+
+def get_resume_point(slug):
+    """Return the record left by an interrupted fill, if all of its chunks are still stored"""
+    resume = redis_client.hgetall(f"video:{slug}:resume")
+    if not resume:
+        return None
+    resume = {key.decode(): value.decode() for key, value in resume.items()}
+    chunks_stored = int(resume["chunks_stored"])
+    prefix = redis_client.getrange(digests_key(slug), 0, chunks_stored * DIGEST_SIZE - 1)
+    if len(prefix) != chunks_stored * DIGEST_SIZE:
+        return None
+    indexes = range(chunks_stored)
+    if chunk_store.count(slug, indexes, manifest_digests(prefix, indexes)) != chunks_stored:
+        return None  # Part of the prefix was evicted
+    resume["digests"] = prefix
+    return resume
+
+def matches_resume_point(resume, response):
+    """Whether an origin response is for the same version of the video as a resume point"""
+    etag = response.headers.get('ETag', '')
+    if resume.get("etag") and etag and etag != resume["etag"]:
+        return False
+    return origin_total_size(response) == int(resume["expected_size"])
+
+class FillSession:
+    """Writes one origin response into video:{slug} and commits the meta hash at the end.
+
+    The meta hash carries the video's chunk size, picked by chunk_size_for() when a
+    fill starts and kept when it resumes, its manifest, the digests of its chunks in
+    order, and the origin ETag the chunks were read under. For MP4 files it also
+    records the top-level box layout and the duration, and the chunks holding ftyp
+    and moov are pinned. A file whose moov comes after mdat has its tail fetched and
+    stored as soon as the mdat header goes by, so players probing for moov while the
+    fill runs find it in the cache.
+
+    With `resume`, the response continues an interrupted fill at chunk
+    resume["chunks_stored"]; otherwise any old entry is cleared first. A session that
+    ends without commit() must be abandon()ed, which keeps the chunks already in Redis
+    and records a resume point so the next fill carries on from there.
+    """
+
+    def __init__(self, clean_name, original_name, response, lock, resume=None, block=True):
+        self.clean_name = clean_name
+        self.original_name = original_name
+        self.lock = lock
+        self.meta_key = f"video:{clean_name}:meta"
+        self.progress_key = f"video:{clean_name}:progress"
+        self.resume_key = f"video:{clean_name}:resume"
+        self.etag = response.headers.get('ETag', '')
+        self.last_modified = response.headers.get('Last-Modified', '')
+        self.content_type = response.headers.get('Content-Type', 'video/mp4')
+
+        self.digests_key = digests_key(clean_name)
+
+        if resume:
+            self.first_chunk = int(resume["chunks_stored"])
+            self.expected_size = int(resume["expected_size"])
+            self.chunk_size = int(resume["chunk_size"])
+            self.digests = bytearray(resume["digests"])
+            self.boxes = None  # The start of the file went by in an earlier fill
+            redis_client.persist(self.digests_key)
+        else:
+            self.first_chunk = 0
+            self.expected_size = origin_total_size(response)
+            self.chunk_size = chunk_size_for(self.expected_size)
+            self.digests = bytearray()
+            self.boxes = mp4box.BoxScanner()
+            # Clear any existing data; we hold the fill lock so nobody else is writing
+            old_manifest = (redis_client.hget(self.meta_key, "manifest")
+                            or redis_client.get(self.digests_key) or b"")
+            redis_client.delete(self.meta_key, self.resume_key, self.digests_key)
+            old_indexes = range(len(old_manifest) // DIGEST_SIZE)
+            chunk_store.release(clean_name, manifest_digests(old_manifest, old_indexes))
+            chunk_store.prepare(clean_name, self.expected_size, self.chunk_size)
+
+        # Announce the layout so viewers can read through while we fill
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(self.progress_key, mapping={
+            "chunks_stored": self.first_chunk,
+            "bytes_stored": self.first_chunk * self.chunk_size,
+            "expected_size": self.expected_size,
+            "chunk_size": self.chunk_size,
+            "content_type": self.content_type,
+            "etag": self.etag,
+            "last_modified": self.last_modified
+        })
+        pipe.pexpire(self.progress_key, FILL_LOCK_TTL_MS)
+        pipe.execute()
+
+        self.next_chunk = self.first_chunk
+        self.bytes_written = 0
+        self.tail = None
+        self.started = time.monotonic()
+        self.writer = PipelinedChunkWriter(clean_name, self.chunk_size, self.progress_key,
+                                           f"video:{clean_name}:chunks-ready",
+                                           first_chunk=self.first_chunk, block=block)
+
+    def write(self, chunk):
+        """Queue the next chunk; returns False if a non-blocking writer had to drop it"""
+        if self.lock.lost.is_set():
+            raise RuntimeError("fill lock lost to another worker")
+        digest = chunk_digest(chunk)
+        if not self.writer.write(self.next_chunk, digest, chunk):
+            return False
+        self.digests += digest
+        if self.boxes is not None and self.boxes.valid:
+            self.boxes.feed(chunk)
+            if self.tail is None and self.expected_size:
+                tail_offset = mp4box.tail_after_media(self.boxes.boxes, self.expected_size)
+                if (tail_offset is not None
+                        and self.expected_size - tail_offset <= MOOV_AHEAD_MAX_MB * 1024 * 1024):
+                    self.tail = threading.Thread(target=self._store_tail, args=(tail_offset,), daemon=True)
+                    self.tail.start()
+        if self.next_chunk % 10 == 0:  # Log every 10 chunks
+            print(f"[+] Queued chunk {self.next_chunk} for {self.clean_name}")
+        self.next_chunk += 1
+        self.bytes_written += len(chunk)
+        return True
+
+    def _store_tail(self, offset):
+        """Store the chunks from the one holding `offset` to the end, ahead of the sequential fill"""
+        first_chunk = offset // self.chunk_size
+        url = f"{VIDEO_SERVER_HOST}{self.original_name}"
+        try:
+            response = origin.get(url, headers={'Range': f"bytes={first_chunk * self.chunk_size}-"}, stream=True)
+            try:
+                if response.status_code != 206 or response.headers.get('ETag', '') != self.etag:
+                    return
+                chunks = iter_fixed_chunks(response.iter_content(self.chunk_size), self.chunk_size)
+                for index, chunk in enumerate(chunks, first_chunk):
+                    if self.lock.lost.is_set():
+                        return
+                    digest = chunk_digest(chunk)
+                    pipe = redis_client.pipeline(transaction=False)
+                    chunk_store.store(pipe, self.clean_name, index, digest, chunk, self.chunk_size)
+                    # Read-through viewers find the chunk by its digest; the fill writes the same one later
+                    pipe.setrange(self.digests_key, index * DIGEST_SIZE, digest)
+                    pipe.execute()
+            finally:
+                response.close()
+            print(f"[+] Stored the tail of {self.clean_name} from chunk {first_chunk} ahead of the fill")
+        except Exception as e:
+            print(f"[!] Could not store the tail of {self.clean_name} ahead of the fill: {e}")
+
+    def _box_layout(self, total_size):
+        """(top-level boxes, duration) of the file if it is MP4, else (None, None)"""
+        scanner = self.boxes
+        if scanner is None:
+            # Resumed fill: walk the box headers in the stored chunks instead
+            def read(offset, size):
+                indexes = range(offset // self.chunk_size, (offset + size - 1) // self.chunk_size + 1)
+                chunks = chunk_store.fetch(self.clean_name, indexes, manifest_digests(self.digests, indexes),
+                                           self.chunk_size)
+                if None in chunks:
+                    raise RuntimeError("chunk evicted during the fill")
+                data = b"".join(bytes(chunk) for chunk in chunks)
+                start = offset - indexes[0] * self.chunk_size
+                return data[start:start + size]
+            try:
+                scanner = mp4box.walk_boxes(read, total_size)
+            except (redis.RedisError, RuntimeError) as e:
+                print(f"[!] Could not read the box layout of {self.clean_name}: {e}")
+                return None, None
+        layout = scanner.layout(total_size)
+        return layout, scanner.duration() if layout else None
+
+    def commit(self):
+        """Wait for every chunk to be written, then publish the meta hash in one transaction"""
+        self.writer.close()
+        if self.tail is not None:
+            self.tail.join()
+        total_size = self.first_chunk * self.chunk_size + self.bytes_written
+        if self.expected_size and total_size != self.expected_size:
+            raise RuntimeError(f"origin sent {total_size} bytes, expected {self.expected_size}")
+
+        layout, duration = self._box_layout(total_size)
+        media = {}
+        if layout:
+            media["boxes"] = mp4box.encode_boxes(layout)
+        if duration:
+            media["duration"] = f"{duration:.3f}"
+
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(self.meta_key, self.progress_key, self.resume_key, self.digests_key)
+        pipe.hset(self.meta_key, mapping={
+            "total_chunks": self.next_chunk,
+            "chunk_size": self.chunk_size,
+            "total_size": total_size,
+            "original_name": self.original_name,
+            "content_type": self.content_type,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "manifest": bytes(self.digests),
+            **media
+        })
+        pipe.execute()
+
+        # After the meta hash, which names the title when pinned chunks are over budget
+        pinned = pinned_chunks(layout or [], self.chunk_size, total_size)
+        try:
+            chunk_store.pin(self.clean_name, pinned, manifest_digests(self.digests, pinned),
+                            self.chunk_size, total_size)
+        except redis.RedisError as e:
+            print(f"[!] Could not pin the head of {self.clean_name}: {e}")
+
+        elapsed = time.monotonic() - self.started
+        metrics.record_fill('committed', elapsed, self.bytes_written)
+        written_mb = self.bytes_written / (1024 * 1024)
+        throughput = written_mb / elapsed if elapsed else 0.0
+        print(f"[✓] Successfully stored {self.original_name} as {self.clean_name} ({self.next_chunk} chunks, "
+              f"{written_mb:.1f} MB in {elapsed:.2f}s, {throughput:.1f} MB/s)")
+
+    def abandon(self):
+        """Keep the chunks written so far and record where the next fill should resume"""
+        try:
+            self.writer.close()
+        except Exception as e:
+            print(f"[!] Writer for {self.clean_name} failed: {e}")
+        if self.tail is not None:
+            self.tail.join()
+        metrics.record_fill('abandoned', time.monotonic() - self.started, self.bytes_written)
+        if self.lock.lost.is_set():
+            return  # The entry belongs to whoever holds the lock now
+
+        chunks_stored = self.writer.chunks_stored
+        try:
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.delete(self.progress_key, self.resume_key)
+            if chunks_stored and self.expected_size:
+                pipe.hset(self.resume_key, mapping={
+                    "chunks_stored": chunks_stored,
+                    "chunk_size": self.chunk_size,
+                    "expected_size": self.expected_size,
+                    "etag": self.etag
+                })
+                # Worth keeping only as long as the chunks it points at may be
+                pipe.expire(self.resume_key, CHUNK_TTL_SECONDS)
+            pipe.expire(self.digests_key, CHUNK_TTL_SECONDS)
+            pipe.execute()
+            print(f"[~] Left {self.clean_name} resumable at chunk {chunks_stored}")
+        except redis.RedisError as e:
+            print(f"[!] Could not record resume point for {self.clean_name}: {e}")
+
+def _take_fill_lock(clean_name):
+    lock = FillLock(clean_name)
+    try:
+        if lock.acquire():
+            return lock
+        print(f"[~] {clean_name} is already being filled by another worker")
+    except redis.ConnectionError as e:
+        mark_redis_down(e)
+    except redis.RedisError as e:
+        print(f"[!] Could not take the fill lock for {clean_name}: {e}")
+    return None
 
 def store_video_in_redis(video_name):
-    if not redis_client:
+    if not redis_available():
         print("[!] Redis not available, skipping storage")
         return
         
@@ -42,37 +491,170 @@ def store_video_in_redis(video_name):
     clean_name = slugify(safe_video_name)
 
     url = f"{VIDEO_SERVER_HOST}{safe_video_name}"
-    print(f"[+] Starting to store video: {url}")
+
+    lock = _take_fill_lock(clean_name)
+    if lock is None:
+        return
 
     try:
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
-            print(f"[!] Failed to fetch video: {url} - Status: {response.status_code}")
+        _fill_video(url, safe_video_name, clean_name, lock)
+    finally:
+        lock.release()
+
+def _fill_video(url, safe_video_name, clean_name, lock):
+    session = None
+    response = None
+    try:
+        # Another worker may have finished the fill between our miss and taking the lock
+        if _is_stored(clean_name):
+            print(f"[~] {clean_name} was stored while we waited, skipping")
             return
 
-        chunk_index = 0
-        chunk_hash_key = f"video:{clean_name}:chunks"
-
-        # Clear any existing data
-        redis_client.delete(chunk_hash_key)
-        meta_key = f"video:{clean_name}:meta"
-        redis_client.delete(meta_key)
-
-        for chunk in response.iter_content(CHUNK_SIZE):
-            if chunk:
-                redis_client.hset(chunk_hash_key, str(chunk_index), chunk)
-                if chunk_index % 10 == 0:  # Log every 10 chunks
-                    print(f"[+] Stored chunk {chunk_index} for {clean_name}")
-                chunk_index += 1
-
-        # Store metadata
-        redis_client.hset(meta_key, mapping={
-            "total_chunks": chunk_index,
-            "original_name": safe_video_name,
-            "content_type": response.headers.get('Content-Type', 'video/mp4')
-        })
+        resume = get_resume_point(clean_name)
+        if resume:
+            print(f"[+] Resuming {url} from chunk {resume['chunks_stored']}")
+            offset = int(resume["chunks_stored"]) * int(resume["chunk_size"])
+            response = origin.get(url, headers={'Range': f"bytes={offset}-"}, stream=True)
+            if response.status_code != 206 or not matches_resume_point(resume, response):
+                print(f"[~] Cannot resume {clean_name} (status {response.status_code}), starting over")
+                response.close()
+                resume = None
 
-        print(f"[✓] Successfully stored {safe_video_name} as {clean_name} ({chunk_index} chunks)")
+        if not resume:
+            print(f"[+] Starting to store video: {url}")
+            response = origin.get(url, stream=True)
+            if response.status_code != 200:
+                print(f"[!] Failed to fetch video: {url} - Status: {response.status_code}")
+                return
+
+        session = FillSession(clean_name, safe_video_name, response, lock, resume)
+        # Chunks must be exactly chunk_size so byte offsets map onto chunk indexes
+        for chunk in iter_fixed_chunks(response.iter_content(session.chunk_size), session.chunk_size):
+            session.write(chunk)
+        session.commit()
+        session = None
 
     except Exception as e:
         print(f"[!] Error while fetching {safe_video_name}: {e}")
+    finally:
+        if session is not None:
+            session.abandon()
+        if response is not None:
+            response.close()
+
+def _abandon_fill(session, lock):
+    session.abandon()
+    lock.release()
+
+class TeeCache:
+    """Cuts a proxied origin stream into the session's chunks for a non-blocking FillSession.
+
+    feed() never waits on Redis: if the writer falls behind, caching stops and the
+    session is abandoned on a background thread. finish() and close() may wait on
+    Redis and are only called once the client has its bytes.
+    """
+
+    def __init__(self, session, lock):
+        self.session = session
+        self.lock = lock
+        self.pending = bytearray()
+        self.chunk_number = 0
+
+    def _write(self, chunk):
+        # Chunks before the resume point are already in Redis
+        if self.chunk_number >= self.session.first_chunk and not self.session.write(chunk):
+            raise RuntimeError("Redis is falling behind the stream")
+        self.chunk_number += 1
+
+    def feed(self, data):
+        """Queue whatever full chunks the bytes just sent to the client complete"""
+        if self.session is None:
+            return
+        self.pending.extend(data)
+        try:
+            chunk_size = self.session.chunk_size
+            while len(self.pending) >= chunk_size:
+                self._write(bytes(self.pending[:chunk_size]))
+                del self.pending[:chunk_size]
+        except Exception as e:
+            print(f"[!] Stopped caching {self.session.clean_name} while streaming: {e}")
+            # Draining the writer waits on Redis, so do it off the client's thread
+            threading.Thread(target=_abandon_fill, args=(self.session, self.lock), daemon=True).start()
+            self.session = None
+            self.pending = bytearray()
+
+    def finish(self):
+        """The origin stream ended: store the last chunk and commit the entry"""
+        if self.session is None:
+            return
+        try:
+            if self.pending:
+                self._write(bytes(self.pending))
+            self.session.commit()
+        except Exception as e:
+            # The client already has every byte; only the cache entry is lost
+            print(f"[!] Could not cache {self.session.clean_name} while streaming: {e}")
+            self.session.abandon()
+        self.session = None
+        self.lock.release()
+
+    def close(self):
+        """The stream stopped early: keep the chunks written so far as a resume point"""
+        if self.session is None:
+            return
+        session, self.session = self.session, None
+        session.abandon()
+        self.lock.release()
+
+def open_tee(video_name, response):
+    """Take the fill lock for a 200 origin response and return a TeeCache, or None.
+
+    Without the lock (or without Redis) the caller should proxy the response uncached.
+    """
+    if response.status_code != 200 or not redis_available():
+        return None
+
+    safe_video_name = urllib.parse.unquote(video_name)
+    clean_name = slugify(safe_video_name)
+    lock = _take_fill_lock(clean_name)
+    if lock is None:
+        return None
+
+    try:
+        resume = get_resume_point(clean_name)
+        if resume and not matches_resume_point(resume, response):
+            resume = None
+        session = FillSession(clean_name, safe_video_name, response, lock, resume, block=False)
+    except Exception as e:
+        print(f"[!] Not caching {clean_name} while streaming: {e}")
+        lock.release()
+        return None
+    return TeeCache(session, lock)
+
+def tee_to_redis(video_name, response, client_chunk_size=64 * 1024):
+    """Yield an origin response to the client while caching it in Redis.
+
+    Redis writes go through a non-blocking PipelinedChunkWriter, so a slow Redis makes
+    us stop caching rather than stall the client. The meta hash is only written once
+    the whole video has passed through; a client that disconnects early leaves a
+    resume point for the next fill. Without the fill lock this is a plain proxy.
+    """
+    tee = None
+    bytes_sent = 0
+    metrics.active_streams.labels('origin').inc()
+    try:
+        tee = open_tee(video_name, response)
+        for data in response.iter_content(client_chunk_size):
+            yield data
+            bytes_sent += len(data)
+            if tee is not None:
+                tee.feed(data)
+        if tee is not None:
+            tee.finish()
+    finally:
+        metrics.active_streams.labels('origin').dec()
+        byte_counter.record(origin_bytes=bytes_sent)
+        if tee is not None:
+            tee.close()
+        # Hand the connection back to the origin pool even if the client left early
+        response.close()
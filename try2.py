@@ -1,115 +1,899 @@
-import re
-import base64
 import os
+import threading
+import time
+import hashlib
+import mimetypes
 import urllib.parse
+from datetime import datetime
+from collections import OrderedDict
 import redis
-from flask import Response, render_template
-import threading
-from redispython import store_video_in_redis
+import origin
+import metrics
+from flask import Response, render_template, request
+from werkzeug.http import parse_range_header, parse_etags, parse_date, unquote_etag, http_date
+from werkzeug.wsgi import wrap_file
+from redisclient import redis_client, redis_available
+from catalogue import catalogue
+import mp4box
+from chunkstore import (chunk_store, byte_counter, hot_chunks, chunk_digest, chunk_size_for, manifest_digests,
+                        pinned_chunks, fill_digests)
+from redispython import slugify, is_fill_in_progress, tee_to_redis
+from fillscheduler import fill_scheduler
+from demand import record_view
 
 # Get environment variables with fallback defaults
 VIDEO_SERVER_HOST = os.environ['VIDEO_SERVER_HOST']
-REDIS_HOST = os.environ['REDIS_HOST']
-REDIS_PORT = int(os.environ['REDIS_PORT'])
-REDIS_USER = os.environ['REDIS_USER']
-REDIS_PASSWORD = os.environ['REDIS_PASSWORD']
-
-CHUNK_SIZE = 1024 * 1024  # 1MB
-
-# Redis client setup with error handling
-try:
-    redis_client = redis.StrictRedis(
-        host=REDIS_HOST,
-        port=REDIS_PORT,
-        db=0,
-        username=REDIS_USER,
-        password=REDIS_PASSWORD,
-        decode_responses=False,  # Binary chunks
-        socket_connect_timeout=5
-    )
-    # Test connection
-    redis_client.ping()
-    print("[✓] Redis connection successful")
-except redis.ConnectionError:
-    print("[!] Redis connection failed - continuing without Redis")
-    redis_client = None
-
-def slugify(name):
-    base, ext = name.rsplit(".", 1)
-    base = re.sub(r'\W+', '_', base)
-    return f"{base}.{ext}"
-
-def is_video_fully_stored(slug):
-    if not redis_client:
-        return False
-        
-    meta_key = f"video:{slug}:meta"
-    total_chunks = redis_client.hget(meta_key, "total_chunks")
 
-    if not total_chunks:
-        return False
+# Chunks fetched per Redis round trip while streaming; bounds per-viewer memory to ~N MB
+STREAM_READAHEAD_CHUNKS = int(os.getenv('STREAM_READAHEAD_CHUNKS', 4))
+# Chunks fetched per round trip when reading a whole video with get_video_chunks
+CHUNK_FETCH_BATCH = int(os.getenv('CHUNK_FETCH_BATCH', 16))
+# Read-through: how long to wait without fill progress before going to S3, and how far
+# ahead of the fill a viewer may be before it fetches that range from S3 itself
+READTHROUGH_WAIT_SECONDS = float(os.getenv('READTHROUGH_WAIT_SECONDS', 5))
+READTHROUGH_MAX_LAG_MB = float(os.getenv('READTHROUGH_MAX_LAG_MB', 8))
+# How far past each viewer's read position chunks are made sure to be stored: seconds
+# of playback for videos whose duration is known, megabytes otherwise; 0 MB turns
+# prefetching off. Positions waiting for the prefetch thread, and videos it remembers
+PREFETCH_SECONDS = float(os.getenv('PREFETCH_SECONDS', 30))
+PREFETCH_MB = float(os.getenv('PREFETCH_MB', 16))
+PREFETCH_QUEUE_LIMIT = int(os.getenv('PREFETCH_QUEUE_LIMIT', 64))
+PREFETCH_TRACKED_VIDEOS = 1024
+# Cache-Control of /stream responses; browsers and the nginx tier revalidate with the ETag after it runs out
+STREAM_CACHE_CONTROL = os.getenv('STREAM_CACHE_CONTROL', 'public, max-age=3600')
 
-    try:
-        total_chunks = int(total_chunks)
-    except ValueError:
+def get_video_meta(slug):
+    """Return the meta hash of a cached video as a str dict (the manifest stays bytes), or None"""
+    if not redis_available():
+        return None
+
+    meta = redis_client.hgetall(f"video:{slug}:meta")
+    if not meta:
+        return None
+    return {key.decode(): value if key == b"manifest" else value.decode() for key, value in meta.items()}
+
+def is_current_meta(meta):
+    """Whether a meta hash is a completed fill of the version of the video S3 still has.
+
+    Individual chunks may have been evicted since; readers fetch those back from S3.
+    """
+    # Entries without a manifest cannot be addressed by content
+    if not meta or not meta.get("manifest") or not meta.get("chunk_size") or not meta.get("total_size"):
         return False
+    return catalogue.is_current(meta.get("original_name", ""), meta.get("etag", ""))
+
+def get_cached_meta(slug):
+    """Return the meta hash of a completed, current fill, or None"""
+    meta = get_video_meta(slug)
+    return meta if is_current_meta(meta) else None
 
-    chunk_hash_key = f"video:{slug}:chunks"
-    actual_chunks = redis_client.hlen(chunk_hash_key)
+def is_video_cached(slug):
+    return get_cached_meta(slug) is not None
 
-    return actual_chunks == total_chunks
+def iter_chunks(slug, first_chunk, last_chunk, chunk_size, manifest, batch_size=CHUNK_FETCH_BATCH):
+    """Yield (index, chunk) for chunks first_chunk..last_chunk, one chunk store fetch per batch.
 
-def get_video_chunks(video_name):
-    if not redis_client:
+    The chunks are addressed by their digests in the manifest, so no KEYS scan or
+    sorting is needed. A chunk missing from the store is yielded as None.
+    """
+    for batch_start in range(first_chunk, last_chunk + 1, batch_size):
+        indexes = range(batch_start, min(batch_start + batch_size, last_chunk + 1))
+        chunks = chunk_store.fetch(slug, indexes, manifest_digests(manifest, indexes), chunk_size)
+        yield from zip(indexes, chunks)
+        # Drop our references before fetching the next batch
+        del chunks
+
+def get_video_chunks(video_name, batch_size=CHUNK_FETCH_BATCH):
+    if not redis_available():
         return []
         
     clean_name = slugify(urllib.parse.unquote(video_name))
-    chunk_hash_key = f"video:{clean_name}:chunks"
-    
-    chunk_keys = redis_client.hkeys(chunk_hash_key)
-    sorted_chunk_keys = sorted(chunk_keys, key=lambda x: int(x.decode() if isinstance(x, bytes) else x))
+    meta = get_cached_meta(clean_name)
+    if not meta:
+        return []
 
     video_chunks = []
-    for chunk_key in sorted_chunk_keys:
-        chunk_data = redis_client.hget(chunk_hash_key, chunk_key)
+    for index, chunk_data in iter_chunks(clean_name, 0, int(meta["total_chunks"]) - 1, int(meta["chunk_size"]),
+                                         meta["manifest"], batch_size):
         if chunk_data:
-            video_chunks.append(chunk_data)
+            video_chunks.append(bytes(chunk_data))
         else:
-            print(f"[!] Chunk {chunk_key} not found.")
+            print(f"[!] Chunk {index} not found.")
     
     return video_chunks
 
+def read_origin_bytes(video_name, start, end, slice_size=0):
+    """Return (bytes [start, end) of a video from S3, its ETag), or None if S3 fails.
+
+    With slice_size the bytes are fetched as the whole slices that hold them (see
+    origin.upstream_ranges).
+    """
+    url = f"{VIDEO_SERVER_HOST}{urllib.parse.unquote(video_name)}"
+    ranges = origin.upstream_ranges(start, end, slice_size)
+    parts = []
+    etag = None
+    for first, last in ranges:
+        try:
+            response = origin.get(url, headers={'Range': f"bytes={first}-{last}"}, stream=True)
+        except Exception as e:
+            print(f"[!] Could not fetch {video_name} bytes {first}-{last} from S3: {e}")
+            return None
+        try:
+            if response.status_code != 206:
+                return None
+            parts.append(response.content)
+        finally:
+            response.close()
+        if etag is not None and response.headers.get('ETag', '') != etag:
+            return None  # Changed on S3 between two slices
+        etag = response.headers.get('ETag', '')
+    offset = start - ranges[0][0]
+    data = b"".join(parts)[offset:offset + end - start]
+    if len(data) != end - start:
+        return None
+    return data, etag
+
+def repair_chunks(slug, video_name, meta, indexes, chunks):
+    """Fill the gaps in a batch of chunks from S3 and put the missing ones back in the chunk store.
+
+    Returns the completed batch, or None if S3 cannot supply the cached version of the
+    video. A video that has changed on S3 (a new ETag, or bytes that do not match the
+    manifest) loses its meta hash, so the next viewer fills it again. Chunks that
+    another reader or the prefetcher in this worker is already fetching are waited
+    for and read from the chunk store rather than fetched from S3 a second time.
+    """
+    chunk_size = int(meta["chunk_size"])
+    digests = manifest_digests(meta["manifest"], indexes)
+    # A title unpinned to stay within CACHE_PINNED_MB gets its chunks back evictable
+    pinned = (set(pinned_chunks(mp4box.decode_boxes(meta), chunk_size, int(meta["total_size"])))
+              if chunk_store.is_pinned(slug) else set())
+    missing = [index for index, chunk in zip(indexes, chunks) if chunk is None]
+    claimed, busy = prefetcher.claim(slug, missing)
+    try:
+        if busy:
+            # Another reader or the prefetcher is already fetching these; take its copy
+            prefetcher.wait_fetched(slug, busy, READTHROUGH_WAIT_SECONDS)
+            chunks = list(chunks)
+            positions = [indexes.index(index) for index in busy]
+            stored = chunk_store.fetch(slug, busy, [digests[i] for i in positions], chunk_size)
+            for i, chunk in zip(positions, stored):
+                chunks[i] = chunk
+            missing = [index for index, chunk in zip(indexes, chunks) if chunk is None]
+            if not missing:
+                return chunks
+        return _fetch_missing_chunks(slug, video_name, meta, indexes, chunks, digests, pinned, missing)
+    finally:
+        prefetcher.release(slug, claimed)
+
+def _fetch_missing_chunks(slug, video_name, meta, indexes, chunks, digests, pinned, missing):
+    chunk_size = int(meta["chunk_size"])
+    start = missing[0] * chunk_size
+    end = min((missing[-1] + 1) * chunk_size, int(meta["total_size"]))
+
+    fetched = read_origin_bytes(video_name, start, end, chunk_size)
+    if fetched is None:
+        return None
+    data, etag = fetched
+    if meta.get("etag") and etag and etag != meta["etag"]:
+        print(f"[~] {slug} changed on S3, dropping the cached copy")
+        redis_client.delete(f"video:{slug}:meta")
+        return None
+
+    repaired = []
+    pipe = redis_client.pipeline(transaction=False)
+    for index, digest, chunk in zip(indexes, digests, chunks):
+        if chunk is None:
+            offset = (index - missing[0]) * chunk_size
+            chunk = data[offset:offset + chunk_size]
+            if chunk_digest(chunk) != digest:
+                print(f"[~] {slug} chunk {index} no longer matches its manifest, dropping the cached copy")
+                redis_client.delete(f"video:{slug}:meta")
+                return None
+            chunk_store.store(pipe, slug, index, digest, chunk, chunk_size, pinned=index in pinned)
+        repaired.append(chunk)
+    try:
+        pipe.execute()
+    except redis.RedisError as e:
+        print(f"[!] Could not re-admit chunks of {slug}: {e}")
+    return repaired
+
+class Prefetcher:
+    """Stores the chunks just ahead of each viewer before the viewer asks for them.
+
+    Streams report their read position with request(). A background thread checks
+    which chunks of the next PREFETCH_SECONDS of playback (PREFETCH_MB when the
+    duration is not known, and never past the end of the requested range) are
+    missing from the chunk store and fetches them from S3, one range request per
+    readahead window, putting them in this worker's hot-chunk cache as well. A viewer
+    that seeks into a stretch that was evicted then waits on S3 for its first window
+    only, not again every few seconds. Each video is only checked up to the
+    furthest point asked for, so a viewer who gives up after 30 seconds never
+    pulls in more than one window past where they stopped.
+
+    A `hot` request also loads stored chunks into the hot-chunk cache; it is used
+    for the moov box a player is about to ask for.
+    """
+
+    def __init__(self, window_bytes, window_seconds=PREFETCH_SECONDS, max_queued=PREFETCH_QUEUE_LIMIT):
+        self.window_bytes = window_bytes
+        self.window_seconds = window_seconds
+        self.max_queued = max_queued
+        self._cond = threading.Condition()
+        self._pending = OrderedDict()  # (slug, first chunk) -> (video_name, meta, last chunk, hot)
+        self._checked = OrderedDict()  # slug -> (etag, first chunk, last chunk) last queued
+        self._fetched = threading.Condition()
+        self._fetching = {}  # slug -> chunks this worker is fetching from S3 right now
+        self._pid = None
+        self.rejected = 0
+        self.chunks_fetched = 0
+
+    def window_for(self, meta):
+        """Bytes to look ahead in a video: window_seconds at its average bitrate if known"""
+        duration = float(meta.get("duration") or 0)
+        if not self.window_bytes or not self.window_seconds or not duration:
+            return self.window_bytes
+        return int(self.window_seconds * int(meta["total_size"]) / duration)
+
+    def request(self, slug, video_name, meta, position, end, hot=False):
+        """Queue a check of the window after `position`, clipped to `end`; never blocks.
+
+        A hot request checks all of [position, end).
+        """
+        window = end - position if hot else self.window_for(meta)
+        if not window or position >= end:
+            return
+        chunk_size = int(meta["chunk_size"])
+        first_chunk = position // chunk_size
+        last_chunk = (min(position + window, end) - 1) // chunk_size
+        etag = meta.get("etag", "")
+        with self._cond:
+            self._start()
+            checked = self._checked.get(slug)
+            checked_from = first_chunk
+            if not hot and checked and checked[0] == etag and checked[1] <= first_chunk <= checked[2] + 1:
+                # Only the part of the window past what was already checked
+                checked_from = checked[1]
+                first_chunk = max(first_chunk, checked[2] + 1)
+                if first_chunk > last_chunk:
+                    return
+            if len(self._pending) >= self.max_queued:
+                self.rejected += 1
+                return
+            self._pending[(slug, first_chunk)] = (video_name, meta, last_chunk, hot)
+            if not hot:
+                self._checked[slug] = (etag, checked_from, last_chunk)
+                self._checked.move_to_end(slug)
+                while len(self._checked) > PREFETCH_TRACKED_VIDEOS:
+                    self._checked.popitem(last=False)
+            self._cond.notify()
+
+    def claim(self, slug, indexes):
+        """Mark the chunks no one else is fetching as being fetched by the caller.
+
+        Returns (claimed, busy): the caller fetches the claimed chunks and hands them
+        back with release(); the busy ones are already on their way from S3.
+        """
+        with self._fetched:
+            fetching = self._fetching.setdefault(slug, set())
+            busy = [index for index in indexes if index in fetching]
+            claimed = [index for index in indexes if index not in fetching]
+            fetching.update(claimed)
+        return claimed, busy
+
+    def wait_fetched(self, slug, indexes, timeout):
+        """Block until none of `indexes` is being fetched, or `timeout` seconds pass"""
+        with self._fetched:
+            return self._fetched.wait_for(
+                lambda: self._fetching.get(slug, set()).isdisjoint(indexes), timeout)
+
+    def release(self, slug, claimed):
+        if not claimed:
+            return
+        with self._fetched:
+            fetching = self._fetching.get(slug, set())
+            fetching.difference_update(claimed)
+            if not fetching:
+                self._fetching.pop(slug, None)
+            self._fetched.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "window_bytes": self.window_bytes,
+                "window_seconds": self.window_seconds,
+                "queued": len(self._pending),
+                "rejected": self.rejected,
+                "chunks_fetched": self.chunks_fetched
+            }
+
+    def warm(self, slug, video_name, meta, first_chunk, last_chunk, hot=False, window=STREAM_READAHEAD_CHUNKS):
+        """Fetch the chunks first_chunk..last_chunk that the chunk store does not have"""
+        for batch_start in range(first_chunk, last_chunk + 1, window):
+            indexes = range(batch_start, min(batch_start + window, last_chunk + 1))
+            digests = manifest_digests(meta["manifest"], indexes)
+            if hot and hot_chunks.max_bytes:
+                cold = [(index, digest) for index, digest, chunk
+                        in zip(indexes, digests, hot_chunks.get_many(digests)) if chunk is None]
+                if cold:
+                    stored = chunk_store.fetch(slug, [index for index, _ in cold],
+                                               [digest for _, digest in cold], int(meta["chunk_size"]))
+                    for (_, digest), chunk in zip(cold, stored):
+                        if chunk is not None:
+                            hot_chunks.put(digest, chunk)
+            missing = set(chunk_store.missing(slug, indexes, digests))
+            if not missing:
+                continue
+            # Only the gaps are needed, so stored chunks are passed as placeholders
+            chunks = repair_chunks(slug, video_name, meta, indexes,
+                                   [None if index in missing else b"" for index in indexes])
+            if chunks is None:
+                return
+            for index, digest, chunk in zip(indexes, digests, chunks):
+                if index in missing:
+                    hot_chunks.put(digest, chunk)
+            with self._cond:
+                self.chunks_fetched += len(missing)
+
+    def _start(self):
+        # Started lazily, and again in a forked worker; called with the condition held
+        if self._pid == os.getpid():
+            return
+        self._pending.clear()
+        self._checked.clear()
+        threading.Thread(target=self._run, name="prefetch", daemon=True).start()
+        self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                (slug, first_chunk), (video_name, meta, last_chunk, hot) = self._pending.popitem(last=False)
+            try:
+                self.warm(slug, video_name, meta, first_chunk, last_chunk, hot)
+            except Exception as e:
+                print(f"[!] Prefetch of {slug} chunks {first_chunk}-{last_chunk} failed: {e}")
+
+
+prefetcher = Prefetcher(int(PREFETCH_MB * 1024 * 1024))
+
+
+def prefetch_moov(slug, video_name, meta, start):
+    """On a read that starts before the moov of a file that keeps moov at the end, get
+    moov into this worker's memory: the player's next request will be for it"""
+    total_size = int(meta["total_size"])
+    tail = mp4box.tail_after_media(mp4box.decode_boxes(meta), total_size)
+    if tail is not None and start < tail:
+        prefetcher.request(slug, video_name, meta, tail, total_size, hot=True)
+
+
+def iter_video_range(slug, video_name, start, end, meta, window=STREAM_READAHEAD_CHUNKS):
+    """Yield the bytes [start, end) of a cached video, fetching only the chunks that cover them.
+
+    Chunks are read ahead `window` at a time with one MGET per round trip, so at most
+    `window` chunks are held in memory regardless of the size of the video. Chunks in
+    this worker's hot-chunk cache skip the chunk store; chunks that have been evicted
+    from it are fetched from S3 and stored again. Each window also asks the
+    prefetcher to make sure the chunks past it are stored.
+    """
+    chunk_size = int(meta["chunk_size"])
+    first_chunk = start // chunk_size
+    last_chunk = (end - 1) // chunk_size
+    source_bytes = {"memory": 0, "store": 0, "origin": 0}
+
+    metrics.active_streams.labels('cache').inc()
+    try:
+        for batch_start in range(first_chunk, last_chunk + 1, window):
+            indexes = range(batch_start, min(batch_start + window, last_chunk + 1))
+            prefetcher.request(slug, video_name, meta, (indexes[-1] + 1) * chunk_size, end)
+            digests = manifest_digests(meta["manifest"], indexes)
+            chunks = hot_chunks.get_many(digests)
+            in_memory = {index for index, chunk in zip(indexes, chunks) if chunk is not None}
+            if len(in_memory) < len(indexes):
+                wanted = [index for index in indexes if index not in in_memory]
+                wanted_digests = [digest for index, digest in zip(indexes, digests) if index not in in_memory]
+                fetched = dict(zip(wanted, chunk_store.fetch(slug, wanted, wanted_digests, chunk_size)))
+                chunks = [fetched.get(index, chunk) for index, chunk in zip(indexes, chunks)]
+
+            missing = {index for index, chunk in zip(indexes, chunks) if chunk is None}
+            if missing:
+                chunks = repair_chunks(slug, video_name, meta, indexes, chunks)
+                if chunks is None:
+                    print(f"[!] Could not recover chunks {sorted(missing)} of {slug}, ending stream")
+                    return
+
+            for index, digest, chunk in zip(indexes, digests, chunks):
+                if index not in in_memory:
+                    hot_chunks.put(digest, chunk)
+                chunk_start = index * chunk_size
+                lo = max(start - chunk_start, 0)
+                hi = min(end - chunk_start, len(chunk))
+                data = chunk if (lo, hi) == (0, len(chunk)) else chunk[lo:hi]
+                # WSGI servers only accept bytes, so disk-backed views are copied here
+                yield data if isinstance(data, bytes) else bytes(data)
+                source = "memory" if index in in_memory else "origin" if index in missing else "store"
+                source_bytes[source] += hi - lo
+            del chunks
+    finally:
+        metrics.active_streams.labels('cache').dec()
+        byte_counter.record(source_bytes["memory"], source_bytes["store"], source_bytes["origin"])
+
+
 def generate_video_stream(video_name):
-    if not redis_client:
+    """Return a generator over a fully cached video, or None if it is not in Redis"""
+    if not redis_available():
         return None
-        
+
     clean_name = slugify(urllib.parse.unquote(video_name))
+    meta = get_cached_meta(clean_name)
+    if not meta:
+        return None
+
+    return iter_video_range(clean_name, video_name, 0, int(meta["total_size"]), meta)
+
+
+def get_fill_progress(slug, wait=READTHROUGH_WAIT_SECONDS):
+    """Return the progress hash of a running fill as a str dict, or None if nobody is filling.
+
+    A fill that has just taken its lock may not have heard back from S3 yet, so wait up
+    to `wait` seconds for it to publish the expected size. A lock without a progress
+    hash belongs to a fill that is not going to publish one, so that is not waited on.
+    """
+    deadline = time.monotonic() + wait
+    while is_fill_in_progress(slug):
+        progress = redis_client.hgetall(f"video:{slug}:progress")
+        if not progress:
+            break
+        progress = {key.decode(): value.decode() for key, value in progress.items()}
+        if int(progress.get("expected_size", 0)):
+            return progress
+        if time.monotonic() >= deadline:
+            break
+        time.sleep(0.05)
+    return None
+
+
+def iter_origin_range(video_name, start, end, slice_size=0, etag=None):
+    """Yield the bytes [start, end) of a video straight from S3.
+
+    With slice_size they are read as whole slices, one request each (see
+    origin.upstream_ranges). With `etag` the stream ends early if a slice comes
+    from a different version of the video.
+    """
+    url = f"{VIDEO_SERVER_HOST}{urllib.parse.unquote(video_name)}"
+    position = start
+    for first, last in origin.upstream_ranges(start, end, slice_size):
+        response = origin.get(url, headers={'Range': f"bytes={first}-{last}"}, stream=True)
+        try:
+            response.raise_for_status()
+            if etag and stream_etag(response.headers.get('ETag', '')) != etag:
+                print(f"[!] {video_name} changed on S3 while streaming, ending stream")
+                return
+            # An origin that ignores Range sends the whole file; skip to our offset
+            skip = position - (0 if response.status_code == 200 else first)
+            remaining = (end if response.status_code == 200 else min(end, last + 1)) - position
+            for data in response.iter_content(chunk_size=64 * 1024):
+                if skip:
+                    dropped = min(skip, len(data))
+                    data = data[dropped:]
+                    skip -= dropped
+                if not data:
+                    continue
+                data = data[:remaining]
+                yield data
+                position += len(data)
+                remaining -= len(data)
+                if not remaining:
+                    break
+        finally:
+            response.close()
+        if response.status_code == 200 or position < min(end, last + 1):
+            return  # The whole file has been read, or the slice came up short
+
+
+def iter_proxied_range(video_name, start, end, slice_size, etag):
+    """iter_origin_range for a /stream miss, counted like the other response bodies"""
+    metrics.active_streams.labels('origin').inc()
+    bytes_sent = 0
+    try:
+        for data in iter_origin_range(video_name, start, end, slice_size, etag):
+            yield data
+            bytes_sent += len(data)
+    finally:
+        metrics.active_streams.labels('origin').dec()
+        byte_counter.record(origin_bytes=bytes_sent)
 
-    if not is_video_fully_stored(clean_name):
+
+def wait_for_chunk(slug, index, pubsub):
+    """Block until the running fill has stored chunk `index`.
+
+    Returns False when nobody is going to store it soon: the fill has stopped, has
+    made no progress for READTHROUGH_WAIT_SECONDS, or is more than
+    READTHROUGH_MAX_LAG_MB behind the chunk.
+    """
+    deadline = time.monotonic() + READTHROUGH_WAIT_SECONDS
+    while True:
+        filling = is_fill_in_progress(slug)
+        chunks_stored, chunk_size = redis_client.hmget(f"video:{slug}:progress", "chunks_stored", "chunk_size")
+        if not filling or chunks_stored is None:
+            # The fill may have completed since we looked, or be committing: the commit
+            # drops the progress hash before the lock is released, and publishes nothing
+            digest = fill_digests(slug, [index])[0]
+            if digest is not None and chunk_store.exists(slug, index, digest):
+                return True
+            if not filling:
+                return False
+        chunks_stored = int(chunks_stored or 0)
+        if index < chunks_stored:
+            return True
+        if (index - chunks_stored) * int(chunk_size or 0) >= READTHROUGH_MAX_LAG_MB * 1024 * 1024:
+            return False
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        if pubsub.get_message(timeout=remaining):
+            deadline = time.monotonic() + READTHROUGH_WAIT_SECONDS
+
+
+def iter_read_through(slug, video_name, start, end, chunk_size, window=STREAM_READAHEAD_CHUNKS):
+    """Yield the bytes [start, end) of a video that is still being filled.
+
+    Chunks already in Redis are served directly. For a missing chunk the viewer waits
+    on the fill's chunks-ready channel; if the fill will not reach it soon, the rest
+    of the range is fetched from S3 instead. A chunk the fill has stored that this
+    chunk store still does not have (evicted already, or on another pod's disk) is
+    read from S3 one window at a time.
+    """
+    position = start
+    pubsub = None
+    stored_chunk = None
+    origin_bytes = 0
+    metrics.active_streams.labels('readthrough').inc()
+    try:
+        while position < end:
+            first_chunk = position // chunk_size
+            last_chunk = min((end - 1) // chunk_size, first_chunk + window - 1)
+            indexes = range(first_chunk, last_chunk + 1)
+            chunks = chunk_store.fetch(slug, indexes, fill_digests(slug, indexes), chunk_size)
+
+            if chunks[0] is None and stored_chunk == first_chunk:
+                window_end = min(end, (last_chunk + 1) * chunk_size)
+                fetched = read_origin_bytes(video_name, position, window_end, chunk_size)
+                if fetched is None:
+                    print(f"[!] Could not read {slug} bytes {position}-{window_end - 1} from S3, ending stream")
+                    return
+                yield fetched[0]
+                origin_bytes += window_end - position
+                position = window_end
+                continue
+
+            if chunks[0] is None:
+                if pubsub is None:
+                    # Subscribe before re-checking progress so no notification is missed
+                    pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(f"video:{slug}:chunks-ready")
+                if wait_for_chunk(slug, first_chunk, pubsub):
+                    stored_chunk = first_chunk
+                    continue
+                print(f"[~] {slug} chunk {first_chunk} is not being filled soon, reading from S3")
+                for data in iter_origin_range(video_name, position, end, chunk_size):
+                    yield data
+                    position += len(data)
+                    origin_bytes += len(data)
+                return
+
+            for index, chunk in zip(indexes, chunks):
+                if chunk is None:
+                    break
+                chunk_start = index * chunk_size
+                lo = position - chunk_start
+                hi = min(end - chunk_start, len(chunk))
+                data = chunk if (lo, hi) == (0, len(chunk)) else chunk[lo:hi]
+                yield data if isinstance(data, bytes) else bytes(data)
+                position = chunk_start + hi
+            del chunks
+    finally:
+        metrics.active_streams.labels('readthrough').dec()
+        byte_counter.record(store_bytes=position - start - origin_bytes, origin_bytes=origin_bytes)
+        if pubsub is not None:
+            pubsub.close()
+
+
+def sendfile_body(slug, meta, start, end):
+    """The bytes [start, end) as a wsgi.file_wrapper over the disk chunk store's file, or None.
+
+    Servers that implement the wrapper with sendfile (gunicorn) then send the range
+    from the page cache without copying it through Python.
+    """
+    data_file = chunk_store.open_range(slug, start, end, int(meta["chunk_size"]), int(meta["total_size"]))
+    if data_file is None:
+        return None
+    byte_counter.record(store_bytes=end - start)
+    return wrap_file(request.environ, data_file)
+
+
+def stream_etag(s3_etag, manifest=b""):
+    """The strong ETag of a video: its S3 ETag, or a digest of its chunk manifest for origins that send none.
+
+    The S3 ETag comes first so that a video has the same ETag whether it is served
+    from the cache, read through a running fill or proxied from S3.
+    """
+    tag = s3_etag.strip().strip('"')
+    if tag and not s3_etag.strip().startswith('W/'):
+        return f'"{tag}"'
+    if manifest:
+        return f'"m{hashlib.blake2b(manifest, digest_size=16).hexdigest()}"'
+    return None
+
+
+def validator_headers(etag, last_modified):
+    headers = {'Accept-Ranges': 'bytes', 'Cache-Control': STREAM_CACHE_CONTROL}
+    if etag:
+        headers['ETag'] = etag
+    if last_modified:
+        headers['Last-Modified'] = last_modified
+    return headers
+
+
+def evaluate_preconditions(request_headers, etag, last_modified):
+    """Apply a request's If-None-Match, If-Modified-Since and If-Range to a video with these validators.
+
+    Returns (not_modified, range_header): whether to answer 304, and the Range
+    header to honour, which is None when there is none or If-Range no longer
+    matches, so the whole video is sent.
+    """
+    if_none_match = request_headers.get('If-None-Match')
+    if_modified_since = request_headers.get('If-Modified-Since')
+    if if_none_match:
+        not_modified = bool(etag) and parse_etags(if_none_match).contains_weak(unquote_etag(etag)[0])
+    elif if_modified_since and last_modified:
+        since, modified = parse_date(if_modified_since), parse_date(last_modified)
+        not_modified = since is not None and modified is not None and modified <= since
+    else:
+        not_modified = False
+
+    range_header = request_headers.get('Range')
+    if_range = request_headers.get('If-Range', '').strip()
+    if range_header and if_range:
+        if if_range.startswith(('"', 'W/')):
+            matches = bool(etag) and if_range == etag  # Strong comparison: weak tags never match
+        else:
+            date = parse_date(if_range)
+            matches = bool(last_modified) and date is not None and date == parse_date(last_modified)
+        if not matches:
+            range_header = None
+    return not_modified, range_header
+
+
+def origin_range(range_header):
+    """The Range to ask S3 for on a miss, or None to fetch the whole video.
+
+    Players open a video with bytes=0-, which is served from a whole-file fetch so
+    the video is cached on the way through; multiple ranges get the whole video too.
+    """
+    byte_range = parse_range_header(range_header) if range_header else None
+    if byte_range is None or len(byte_range.ranges) != 1 or byte_range.ranges[0] == (0, None):
         return None
+    return byte_range.to_header()
+
+
+def relay_origin(request_headers, upstream_range, status, origin_headers):
+    """Status and headers for passing an S3 response on to a /stream client.
 
-    video_chunks = get_video_chunks(video_name)
-    return b"".join(video_chunks) if video_chunks else None
+    Returns 304 when the client's copy is still current, and None when the client's
+    If-Range no longer matches the ranged response, so the caller should fetch and
+    send the whole video instead. Error statuses come back with no headers.
+    """
+    if status not in (200, 206):
+        return status, {}
+    etag = stream_etag(origin_headers.get('ETag', ''))
+    last_modified = origin_headers.get('Last-Modified', '')
+    headers = validator_headers(etag, last_modified)
+    not_modified, range_header = evaluate_preconditions(request_headers, etag, last_modified)
+    if not_modified:
+        return 304, headers
+
+    content_length = origin_headers.get('Content-Length')
+    if status == 206:
+        if upstream_range and not range_header:
+            return None
+        headers['Content-Range'] = origin_headers.get('Content-Range', '')
+    elif range_header and content_length and int(content_length):
+        byte_range = parse_range_header(range_header)
+        if byte_range is not None and byte_range.ranges == [(0, None)]:
+            # A bytes=0- request answered from the whole file
+            status = 206
+            headers['Content-Range'] = f"bytes 0-{int(content_length) - 1}/{content_length}"
+    if content_length:
+        headers['Content-Length'] = content_length
+    return status, headers
+
+
+def listing_http_date(value):
+    """An S3 listing's LastModified as an HTTP date, or None"""
+    try:
+        return http_date(datetime.fromisoformat(value.replace('Z', '+00:00')))
+    except ValueError:
+        return None
+
+
+def plan_sliced_miss(video_name, request_headers):
+    """How to answer a ranged /stream miss from whole slices (ORIGIN_RANGE_MODE=slice).
+
+    The S3 listing supplies the size, and so the slice size, and the validators up
+    front. Returns None to proxy the request as it is (not in slice mode, no range
+    to slice, or a video the listing does not have), otherwise
+    (status, headers, span, slice_size, etag): 206 for the bytes span = (start, end),
+    304 or 416, or 200 when If-Range failed and the whole video should be sent.
+    """
+    if origin.ORIGIN_RANGE_MODE != 'slice' or not origin_range(request_headers.get('Range')):
+        return None
+    entry = catalogue.entry(urllib.parse.unquote(video_name))
+    if entry is None or not entry['size_bytes']:
+        return None
+    total_size = entry['size_bytes']
+    etag = stream_etag(entry['etag'])
+    last_modified = listing_http_date(entry['last_modified'])
+
+    headers = validator_headers(etag, last_modified)
+    not_modified, range_header = evaluate_preconditions(request_headers, etag, last_modified)
+    if not_modified:
+        return 304, headers, None, 0, etag
+    if not range_header:
+        return 200, headers, None, 0, etag
+    byte_range = parse_range_header(range_header)
+    span = byte_range.range_for_length(total_size)
+    if span is None:
+        headers['Content-Range'] = f"bytes */{total_size}"
+        return 416, headers, None, 0, etag
+    headers['Content-Range'] = byte_range.to_content_range_header(total_size)
+    headers['Content-Length'] = str(span[1] - span[0])
+    return 206, headers, span, chunk_size_for(total_size), etag
+
+
+def serve_origin(video_name, request_headers):
+    """Proxy /stream from S3 for a video the cache cannot serve.
+
+    A whole-file fetch is cached as it passes through; a ranged one (a viewer
+    seeking into an uncached video) is not, so a background fill is queued instead.
+    In slice mode a ranged one is read from S3 as whole slices of the size the
+    video's chunks will have.
+    """
+    sliced = plan_sliced_miss(video_name, request_headers)
+    if sliced is not None:
+        status, headers, span, slice_size, etag = sliced
+        if status == 206:
+            queue_fill(video_name)
+            content_type = mimetypes.guess_type(urllib.parse.unquote(video_name))[0] or 'video/mp4'
+            return Response(iter_proxied_range(video_name, span[0], span[1], slice_size, etag), status=206,
+                            content_type=content_type, headers=headers, direct_passthrough=True)
+        if status != 200:
+            return Response(status=status, headers=headers)
+        # If-Range no longer matches, so the client gets the whole video, and it is cached
+        request_headers = {}
+
+    url = f"{VIDEO_SERVER_HOST}{video_name}"
+    upstream_range = origin_range(request_headers.get('Range'))
+    response = origin.get(url, headers={'Range': upstream_range} if upstream_range else None, stream=True)
+    relay = relay_origin(request_headers, upstream_range, response.status_code, response.headers)
+    if relay is None:
+        # If-Range no longer matches, so the client gets the whole video
+        response.close()
+        upstream_range = None
+        response = origin.get(url, stream=True)
+        relay = relay_origin({}, None, response.status_code, response.headers)
+
+    status, headers = relay
+    if status not in (200, 206):
+        response.close()
+        if status == 304:
+            return Response(status=304, headers=headers)
+        return Response(f"Error streaming video: origin returned {status}", status=status)
+
+    if upstream_range:
+        queue_fill(video_name)
+    return Response(tee_to_redis(video_name, response), status=status,
+                    content_type=response.headers.get('Content-Type', 'video/mp4'), headers=headers,
+                    direct_passthrough=True)
+
+
+def queue_fill(video_name):
+    """Start caching a video in the background unless a worker is already filling it"""
+    if redis_available() and not is_fill_in_progress(slugify(urllib.parse.unquote(video_name))):
+        if not fill_scheduler.submit(video_name):
+            print(f"[!] Fill queue full, not caching {urllib.parse.unquote(video_name)}")
+
+
+def serve_video_range(video_name, request_headers):
+    """Serve a video from Redis, answering a single byte range with 206.
+
+    Fully cached videos are served from their chunks; a read that starts before the
+    moov of an MP4 that keeps it at the end also gets moov loaded for the player's
+    next request. Videos that another worker is still filling are served
+    read-through. Responses carry the video's ETag and Last-Modified and honour
+    If-None-Match, If-Modified-Since and If-Range. Returns None when neither applies
+    so the caller can fall back to S3.
+    """
+    clean_name = slugify(urllib.parse.unquote(video_name))
+    meta = get_cached_meta(clean_name)
+    if meta:
+        total_size = int(meta["total_size"])
+        content_type = meta.get("content_type", "video/mp4")
+        etag = stream_etag(meta.get("etag", ""), meta["manifest"])
+        last_modified = meta.get("last_modified")
+
+        def read(start, end):
+            prefetch_moov(clean_name, video_name, meta, start)
+            return (sendfile_body(clean_name, meta, start, end)
+                    or iter_video_range(clean_name, video_name, start, end, meta))
+    else:
+        progress = get_fill_progress(clean_name) if redis_available() else None
+        if not progress:
+            return None
+        total_size = int(progress["expected_size"])
+        chunk_size = int(progress["chunk_size"])
+        content_type = progress.get("content_type", "video/mp4")
+        etag = stream_etag(progress.get("etag", ""))
+        last_modified = progress.get("last_modified")
+        read = lambda start, end: iter_read_through(clean_name, video_name, start, end, chunk_size)
+
+    headers = validator_headers(etag, last_modified)
+    not_modified, range_header = evaluate_preconditions(request_headers, etag, last_modified)
+    if not_modified:
+        return Response(status=304, headers=headers)
+    byte_range = parse_range_header(range_header) if range_header else None
+    if byte_range is None or len(byte_range.ranges) != 1:
+        # No range (or a multi-range we choose not to honour): stream the whole file
+        headers['Content-Length'] = str(total_size)
+        return Response(read(0, total_size), content_type=content_type, headers=headers,
+                        direct_passthrough=True)
+
+    span = byte_range.range_for_length(total_size)
+    if span is None:
+        headers['Content-Range'] = f"bytes */{total_size}"
+        return Response(status=416, headers=headers)
+
+    start, end = span
+    headers['Content-Range'] = byte_range.to_content_range_header(total_size)
+    headers['Content-Length'] = str(end - start)
+    return Response(read(start, end), status=206, content_type=content_type, headers=headers,
+                    direct_passthrough=True)
+
+
+def get_fill_status(video_name):
+    """Describe the cache state of a video for the /api/video-status poller"""
+    clean_name = slugify(urllib.parse.unquote(video_name))
+    if is_video_cached(clean_name):
+        return {"status": "ready"}
+    if not is_fill_in_progress(clean_name):
+        return {"status": "not_cached"}
+
+    bytes_stored, expected_size = redis_client.hmget(
+        f"video:{clean_name}:progress", "bytes_stored", "expected_size")
+    progress = f"Caching... {int(bytes_stored or 0) / (1024 * 1024):.1f} MB"
+    if expected_size and int(expected_size):
+        progress += f" of {int(expected_size) / (1024 * 1024):.1f} MB"
+    return {"status": "processing", "progress": progress}
 
 
 def stream_video(video_name):
     safe_video_name = urllib.parse.unquote(video_name)
-    
-    # Check if video is in Redis
-    video_data = generate_video_stream(video_name)
+    clean_name = slugify(safe_video_name)
+    if redis_available():
+        record_view(safe_video_name)
 
-    if video_data:
-        # Convert binary video data to base64 data URL
-        video_base64 = base64.b64encode(video_data).decode('utf-8')
-        video_data_url = f"data:video/mp4;base64,{video_base64}"
-        
+    # Check if video is in Redis
+    if is_video_cached(clean_name):
+        metrics.watch_requests.labels('hit').inc()
+        # Let the player pull byte ranges from /stream instead of embedding the file
         return render_template('videos.html', 
                             video_name=safe_video_name, 
-                            video_url=video_data_url,
+                            video_url=f"/stream/{urllib.parse.quote(safe_video_name)}",
                             video_ready=True)
     else:
-        # Video not in Redis - start background storage
-        if redis_client:  # Only store in Redis if Redis is available
-            threading.Thread(target=store_video_in_redis, args=(video_name,), daemon=True).start()
+        metrics.watch_requests.labels('miss').inc()
+        # Video not in Redis - start background storage unless a worker is already filling it
+        queue_fill(video_name)
         # Return None to indicate video not in Redis
         return None
@@ -0,0 +1,252 @@
+"""Fill the cache ahead of viewers with the titles they have been watching most.
+
+The cache normally fills only when someone opens /watch, and Redis keeps nothing
+across a restart (see redis.conf), so afterwards the first viewer of every title
+waits on S3. A warm-up ranks titles by recent demand (see demand), picks the most
+watched WARMUP_TOP_N whose sizes fit in WARMUP_BUDGET_MB, and fills them through
+store_video_in_redis, the same path a viewer's fill takes, WARMUP_CONCURRENCY at a
+time. Titles that are already cached count against the budget but are not fetched
+again.
+
+The plan and the titles finished so far are kept in warmup:state and warmup:done,
+so a warm-up that is interrupted carries on where it stopped, and each fill it
+interrupted resumes from its own resume point. Only one warm-up runs at a time
+across all workers, under warmup:lock.
+
+Each worker also checks every WARMUP_CHECK_SECONDS whether a warm-up is due: none
+has run since Redis started, the last one never finished, or it finished more than
+WARMUP_INTERVAL_SECONDS ago (0 turns the background warm-up off). By hand:
+
+    python warmup.py --top 20 --budget-mb 2048
+    python warmup.py --status
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import redis
+from redisclient import redis_client, redis_available
+from catalogue import catalogue
+from demand import recent_demand, DEMAND_HOURS, DEMAND_ACCESS_LOG
+from redispython import FillLock, slugify, store_video_in_redis
+from try2 import is_video_cached
+
+# Titles per warm-up, the total size they may add up to, and fills run at once
+WARMUP_TOP_N = int(os.getenv('WARMUP_TOP_N', 20))
+WARMUP_BUDGET_MB = float(os.getenv('WARMUP_BUDGET_MB', 2048))
+WARMUP_CONCURRENCY = int(os.getenv('WARMUP_CONCURRENCY', 2))
+WARMUP_INTERVAL_SECONDS = float(os.getenv('WARMUP_INTERVAL_SECONDS', 1800))
+WARMUP_CHECK_SECONDS = 60
+
+WARMUP_STATE_KEY = "warmup:state"
+WARMUP_DONE_KEY = "warmup:done"
+WARMUP_LOCK_KEY = "warmup:lock"
+
+
+def plan_warmup(top_n=WARMUP_TOP_N, budget_bytes=WARMUP_BUDGET_MB * 1024 * 1024,
+                hours=DEMAND_HOURS, access_log=DEMAND_ACCESS_LOG):
+    """The titles to warm, most watched first, as [name, size] pairs.
+
+    At most top_n titles adding up to at most budget_bytes; a title too large for
+    what is left of the budget is passed over for smaller ones further down. Titles
+    the S3 listing no longer has are ignored.
+    """
+    files, version, error = catalogue.snapshot()
+    if version is None:
+        raise RuntimeError(f"no S3 listing to size titles from: {error}")
+    sizes = {f['name']: f['size_bytes'] for f in files}
+
+    plan = []
+    remaining = budget_bytes
+    for name, _ in recent_demand(hours, access_log).most_common():
+        if len(plan) >= top_n:
+            break
+        size = sizes.get(name)
+        if size is None or size > remaining:
+            continue
+        plan.append([name, size])
+        remaining -= size
+    return plan
+
+
+def warmup_status():
+    """The running or last warm-up's plan and progress, or None if there has not been one"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(WARMUP_STATE_KEY)
+    pipe.smembers(WARMUP_DONE_KEY)
+    pipe.exists(WARMUP_LOCK_KEY)
+    state, done, running = pipe.execute()
+    if not state:
+        return None
+    state = {key.decode(): value.decode() for key, value in state.items()}
+    done = {name.decode() for name in done}
+
+    plan = json.loads(state["plan"])
+    return {
+        "running": bool(running),
+        "started_at": float(state["started_at"]),
+        "finished_at": float(state["finished_at"]) if "finished_at" in state else None,
+        "titles": len(plan),
+        "titles_done": sum(1 for name, _ in plan if name in done),
+        "planned_bytes": sum(size for _, size in plan),
+        "done_bytes": sum(size for name, size in plan if name in done),
+        "not_cached": json.loads(state.get("not_cached", "[]")),
+        "plan": plan
+    }
+
+
+def _save_plan(plan):
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.delete(WARMUP_STATE_KEY, WARMUP_DONE_KEY)
+    pipe.hset(WARMUP_STATE_KEY, mapping={"plan": json.dumps(plan), "started_at": time.time()})
+    pipe.execute()
+
+
+def _fill_title(name, lock):
+    """Fill one title as a viewer's fill would; returns whether it is now cached"""
+    if lock.lost.is_set():
+        return False
+    store_video_in_redis(urllib.parse.quote(name))
+    return is_video_cached(slugify(name))
+
+
+def run_warmup(plan, lock, concurrency=WARMUP_CONCURRENCY):
+    """Fill the titles of `plan` not yet marked done, reporting progress; returns those left uncached"""
+    done = {name.decode() for name in redis_client.smembers(WARMUP_DONE_KEY)}
+    todo = []
+    for name, size in plan:
+        if name not in done and is_video_cached(slugify(name)):
+            redis_client.sadd(WARMUP_DONE_KEY, name)
+            done.add(name)
+        if name not in done:
+            todo.append((name, size))
+
+    total_bytes = sum(size for _, size in plan)
+    done_bytes = sum(size for name, size in plan if name in done)
+    titles_done = len(plan) - len(todo)
+    print(f"[+] Warm-up: {titles_done} of {len(plan)} titles already cached, filling {len(todo)}")
+
+    not_cached = []
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="cache-warmup") as pool:
+        futures = {pool.submit(_fill_title, name, lock): (name, size) for name, size in todo}
+        for future in as_completed(futures):
+            name, size = futures[future]
+            try:
+                cached = future.result()
+            except Exception as e:
+                print(f"[!] Warm-up fill of {name} crashed: {e}")
+                cached = False
+            if cached:
+                redis_client.sadd(WARMUP_DONE_KEY, name)
+                titles_done += 1
+                done_bytes += size
+            else:
+                not_cached.append(name)
+            print(f"[{'✓' if cached else '!'}] Warm-up {titles_done}/{len(plan)} titles, "
+                  f"{done_bytes / (1024 * 1024):.1f} of {total_bytes / (1024 * 1024):.1f} MB: "
+                  f"{name} {'cached' if cached else 'not cached'}")
+    return not_cached
+
+
+def warmup(top_n=WARMUP_TOP_N, budget_mb=WARMUP_BUDGET_MB, concurrency=WARMUP_CONCURRENCY,
+           hours=DEMAND_HOURS, access_log=DEMAND_ACCESS_LOG, resume=True, min_interval=0):
+    """Carry on with an unfinished warm-up (unless resume is False) or plan and run a new one.
+
+    With min_interval, a warm-up that finished less than that many seconds ago is
+    left alone. Returns False if another process is warming right now.
+    """
+    lock = FillLock(None, key=WARMUP_LOCK_KEY)
+    if not lock.acquire():
+        print("[~] A warm-up is already running elsewhere")
+        return False
+    try:
+        state = warmup_status()
+        if state and state["finished_at"] and time.time() - state["finished_at"] < min_interval:
+            return True
+        if resume and state and not state["finished_at"]:
+            plan = state["plan"]
+            print(f"[+] Resuming warm-up of {len(plan)} titles")
+        else:
+            plan = plan_warmup(top_n, budget_mb * 1024 * 1024, hours, access_log)
+            if not plan:
+                print("[~] No recent demand for any listed title, nothing to warm")
+            _save_plan(plan)
+
+        not_cached = run_warmup(plan, lock, concurrency)
+        if not lock.lost.is_set():
+            redis_client.hset(WARMUP_STATE_KEY, mapping={
+                "finished_at": time.time(),
+                "not_cached": json.dumps(not_cached)
+            })
+    finally:
+        lock.release()
+    return True
+
+
+class WarmupScheduler:
+    """Runs warm-ups in the background of every worker; warmup:lock lets one run at a time"""
+
+    def __init__(self, interval=WARMUP_INTERVAL_SECONDS, check_seconds=WARMUP_CHECK_SECONDS):
+        self.interval = interval
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Started lazily so that a pre-forking server starts it in each worker process
+        if not self.interval or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="cache-warmup-scheduler", daemon=True).start()
+
+    def is_due(self):
+        finished_at = redis_client.hget(WARMUP_STATE_KEY, "finished_at")
+        return not finished_at or time.time() - float(finished_at) >= self.interval
+
+    def _run(self):
+        while True:
+            time.sleep(self.check_seconds)
+            try:
+                if redis_available() and self.is_due():
+                    warmup(min_interval=self.interval)
+            except (redis.RedisError, RuntimeError) as e:
+                print(f"[!] Background warm-up failed: {e}")
+
+
+warmup_scheduler = WarmupScheduler()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the cache with the most watched titles")
+    parser.add_argument('--top', type=int, default=WARMUP_TOP_N, help="most titles to warm")
+    parser.add_argument('--budget-mb', type=float, default=WARMUP_BUDGET_MB,
+                        help="most megabytes the warmed titles may add up to")
+    parser.add_argument('--concurrency', type=int, default=WARMUP_CONCURRENCY, help="fills run at once")
+    parser.add_argument('--hours', type=int, default=DEMAND_HOURS, help="how far back demand is counted")
+    parser.add_argument('--access-log', default=DEMAND_ACCESS_LOG,
+                        help="nginx access log in video_log format to count views from as well")
+    parser.add_argument('--fresh', action='store_true', help="plan anew instead of resuming an unfinished warm-up")
+    parser.add_argument('--dry-run', action='store_true', help="print the plan without filling anything")
+    parser.add_argument('--status', action='store_true', help="print the progress of the current or last warm-up")
+    args = parser.parse_args()
+
+    if args.status:
+        print(json.dumps(warmup_status(), indent=2))
+        return
+    if args.dry_run:
+        for name, size in plan_warmup(args.top, args.budget_mb * 1024 * 1024, args.hours, args.access_log):
+            print(f"{size / (1024 * 1024):>10.1f} MB  {name}")
+        return
+    if not warmup(args.top, args.budget_mb, args.concurrency, args.hours, args.access_log, resume=not args.fresh):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+"""WSGI entry point for gunicorn's threaded workers.
+
+    gunicorn -c gunicorn.conf.py
+
+The default worker class serves asgi:application instead; see gunicorn.conf.py.
+"""
+from app import app
+
+application = app